@@ -88,7 +88,10 @@ class cgalTriangleExpanderNode(Node):
         Node.__init__(self, name, allowAddOutput=False, terminals={
             'triangulation_3': {'io':'in'},
             'triangles': {'io':'out'},
-            'normals': {'io':'out'}
+            'normals': {'io':'out'},
+            'vertices': {'io':'out'},
+            'indices': {'io':'out'},
+            'vertex_normals': {'io':'out'}
         })
 
     def process(self, triangulation_3, display=True):
@@ -114,4 +117,19 @@ class cgalTriangleExpanderNode(Node):
             normals[i] = [normal_vector.x(), normal_vector.y(), normal_vector.z()]
         normals = normals/np.linalg.norm(normals, axis=1)[:,None]
 
-        return {'triangles':triangles, 'normals':normals}
\ No newline at end of file
+        # shared vertices for indexed drawing
+        vertices, indices = np.unique(triangles, axis=0, return_inverse=True)
+        indices = indices.reshape(-1,3)
+
+        # average the normals of the faces around each vertex, facets of a triangulation
+        # are not consistently oriented so flip them to agree with the first face of the vertex
+        corner_faces = np.repeat(np.arange(nt), 3)
+        _, first_corner = np.unique(indices.ravel(), return_index=True)
+        reference = normals[corner_faces[first_corner]]
+        corner_normals = normals[corner_faces]
+        sign = np.sign(np.einsum('ij,ij->i', corner_normals, reference[indices.ravel()]))
+        vertex_normals = np.zeros_like(vertices)
+        np.add.at(vertex_normals, indices.ravel(), corner_normals*sign[:,None])
+        vertex_normals = vertex_normals/np.linalg.norm(vertex_normals, axis=1)[:,None]
+
+        return {'triangles':triangles, 'normals':normals, 'vertices':vertices, 'indices':indices, 'vertex_normals':vertex_normals}
\ No newline at end of file
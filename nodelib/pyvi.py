@@ -6,6 +6,7 @@ from PyQt5 import QtCore
 
 from pyvi.gloo import *
 from pyvi.util import *
+from pyvi.octree import Octree, OctreePainter
 
 
 class pvBBoxNode(CtrlNode):
@@ -31,7 +32,7 @@ class pvBBoxNode(CtrlNode):
         bbox_clip = BBox(np.array(ps))
         result = {'bbox': bbox_clip}
         if not points is None:
-            result['idx'] = np.all(np.logical_and(bbox_clip.mi <= points, points <= bbox_clip.ma), axis=1), 's'
+            result['idx'] = bbox_clip.contains(points), 's'
 
         return result
 
@@ -43,6 +44,7 @@ class pvPointPainterNode(pvPainterNode):
         ('draw_mode',  'combo', {'values':['simple', 'disk', 'oriented_disk']}),
         ('color_mode',  'combo', {'values':['fixed', 'texture', 'color']}),
         ('color',  'color', {'color':(128,128,0)}),
+        ('vertex_format',  'combo', {'values':['float', 'compact']}),
         ('gradient',  'gradient', {})
     ]
     
@@ -92,10 +94,11 @@ class pvPointPainterNode(pvPainterNode):
             checked = state > 0
             self.pvPainter.program.rebuild(lightning=checked)
 
-    def updateGL(self, struct_array, image_gradient, options):
+    def updateGL(self, data, image_gradient, options):
+        names, struct_arrays = data
         self.pvPainter.program.setOptions(**options)
         self.pvPainter.colormap.setImage(image_gradient)
-        self.pvPainter.buffer.setData(struct_array)
+        self.setAttributes(names, struct_arrays)
 
         if 'u_point_size' in self.pvPainter.program.uniforms:
             self.pvPainter.program.setUniformValue('u_point_size', options['point_size'])
@@ -103,27 +106,18 @@ class pvPointPainterNode(pvPainterNode):
             self.pvPainter.program.setUniformValue('u_color', options['color'])
 
     def process(self, a_position, a_normal, a_color, a_intensity, bbox_clip, display=True):
-        dtypes=[('a_position', np.float32, 3)]
-        if not a_normal is None:
-            dtypes.append(('a_normal', np.float32, 3))
-        if not a_intensity is None:
-            dtypes.append(('a_intensity', np.float32, 1))
-        if not a_color is None:
-            dtypes.append(('a_color', np.float32, 4))
-
-        struct_array = np.empty( len(a_position), dtype=dtypes )
-        struct_array['a_position'] = a_position
-        if not a_normal is None:
-            struct_array['a_normal'] = a_normal
-        if not a_intensity is None:
-            struct_array['a_intensity'] = a_intensity
-        if not a_color is None:
-            struct_array['a_color'] = a_color
-
-        # bbox clipping
-        if bbox_clip:
-            bbox_clip_mask = np.all(np.logical_and(bbox_clip.mi <= a_position, a_position <= bbox_clip.ma), axis=1)
-            struct_array = struct_array[bbox_clip_mask]
+        attributes = {'a_position':a_position, 'a_normal':a_normal, 'a_color':a_color, 'a_intensity':a_intensity}
+        attributes = dict((key, value) for key, value in attributes.items() if not value is None)
+        vertex_format = self.ctrls['vertex_format'].currentText()
+
+        # only rebuild the attributes whose input changed, or all of them if other points are staged
+        changed = self.changedInputs(attributes, vertex_format, bbox_clip)
+        bbox_clip_mask = None
+        if 'a_position' in changed and bbox_clip:
+            bbox_clip_mask = bbox_clip.contains(a_position)
+        struct_arrays = self.stager.stagePoints(attributes, vertex_format, bbox_clip_mask, changed)
+        # picked rows are reported as indices of the input points
+        self.pvPainter.vertex_ids = self.stager.rows
 
         options = {}
         options['point_size'] = self.ctrls['point_size'].value()
@@ -133,9 +127,168 @@ class pvPointPainterNode(pvPainterNode):
         options['draw_mode'] = self.ctrls['draw_mode'].currentText()
         image_gradient = self.ctrls['gradient'].getLookupTable(nPts=self.pvPainter.colormap.width, alpha=False)
 
-        self.sigUpdateGL.emit(struct_array, image_gradient, options)
+        self.sigUpdateGL.emit((list(attributes), struct_arrays), image_gradient, options)
 
-        if self.pvPainter.is_initialised:
+        # batched painters are never initialised themselves
+        if not self.pvPainter.buffer.data is None:
+            bbox=self.pvPainter.getBBox()
+        else:
+            bbox=None
+
+        return {
+            'out': self.pvPainter,
+            'bbox': bbox
+        }
+
+class pvOctreePainterNode(pvPointPainterNode):
+    nodeName = 'pvOctreePainter'
+    uiTemplate = [
+        ('point_size',  'doubleSpin', {'min':1.0, 'max':999.0, 'value':3.0, 'step':0.2}),
+        ('lightning',  'check', {'checked':True}),
+        ('draw_mode',  'combo', {'values':['simple', 'disk', 'oriented_disk']}),
+        ('color_mode',  'combo', {'values':['fixed', 'texture', 'color']}),
+        ('color',  'color', {'color':(128,128,0)}),
+        ('max_error',  'doubleSpin', {'min':0.1, 'max':100.0, 'value':2.0, 'step':0.5}),
+        ('gpu_budget',  'intSpin', {'min':16, 'max':16384, 'value':512}),
+        ('gradient',  'gradient', {})
+    ]
+
+    def __init__(self, name):
+        # points are read from an octree directory written by pyvi.octree.buildOctree
+        pvPainterNode.__init__(self, name, draw_type='points', terminals={
+        'path': {'io':'in'},
+        'out': {'io':'out'},
+        'bbox': {'io':'out'}
+        })
+        self.ctrls['color_mode'].currentIndexChanged.connect(self.changeColorMode)
+        self.ctrls['draw_mode'].currentIndexChanged.connect(self.changeDrawMode)
+        self.ctrls['lightning'].stateChanged.connect(self.changeLightning)
+        self.ctrls['gradient'].sigGradientChangeFinished.connect(self.changeGradient)
+        self.octree_path = None
+
+    def createPainter(self, shader, draw_type, buffer, colormap):
+        # the points are streamed into the slot buffer of the painter
+        return OctreePainter(shader, colormap)
+
+    def updateGL(self, data, image_gradient, options):
+        self.pvPainter.program.setOptions(**options)
+        self.pvPainter.colormap.setImage(image_gradient)
+
+        if 'u_point_size' in self.pvPainter.program.uniforms:
+            self.pvPainter.program.setUniformValue('u_point_size', options['point_size'])
+        if 'u_color' in self.pvPainter.program.uniforms:
+            self.pvPainter.program.setUniformValue('u_color', options['color'])
+
+    def process(self, path, display=True):
+        if path is None:
+            raise Exception('set proper inputs')
+        if path != self.octree_path:
+            self.octree_path = path
+            self.pvPainter.setOctree(Octree(path))
+        self.pvPainter.max_error = self.ctrls['max_error'].value()
+        gpu_budget = self.ctrls['gpu_budget'].value() * 2**20
+        if gpu_budget != self.pvPainter.gpu_budget:
+            self.pvPainter.setGPUBudget(gpu_budget)
+
+        options = {}
+        options['point_size'] = self.ctrls['point_size'].value()
+        options['color'] = np.array(self.ctrls['color'].color(mode='float'), dtype=np.float32)
+        options['lightning'] = self.ctrls['lightning'].checkState() > 0
+        options['color_mode'] = self.ctrls['color_mode'].currentText()
+        options['draw_mode'] = self.ctrls['draw_mode'].currentText()
+        image_gradient = self.ctrls['gradient'].getLookupTable(nPts=self.pvPainter.colormap.width, alpha=False)
+
+        self.sigUpdateGL.emit(None, image_gradient, options)
+
+        return {
+            'out': self.pvPainter,
+            'bbox': self.pvPainter.getBBox()
+        }
+
+    def destroy(self, node):
+        # the vertex array and the slot buffer
+        self.pvPainter.delete()
+        self.pvPainter.colormap.delete()
+        self.pvPainter.program.delete()
+
+class pvBallPainterNode(pvPainterNode):
+    nodeName = 'pvBallPainter'
+    uiTemplate = [
+        ('radius_scale',  'doubleSpin', {'min':0.01, 'max':100.0, 'value':1.0, 'step':0.1}),
+        ('lightning',  'check', {'checked':True}),
+        ('color_mode',  'combo', {'values':['fixed', 'texture', 'color']}),
+        ('color',  'color', {'color':(128,128,0)}),
+        ('vertex_format',  'combo', {'values':['float', 'compact']}),
+        ('gradient',  'gradient', {})
+    ]
+
+    def __init__(self, name):
+        # eg ma_coords and ma_radii of a maExpander
+        pvPainterNode.__init__(self, name, draw_type='balls', terminals={
+        'a_position': {'io':'in'},
+        'a_radius': {'io':'in'},
+        'a_color': {'io':'in'},
+        'a_intensity': {'io':'in'},
+        'bbox_clip': {'io':'in'},
+        'out': {'io':'out'},
+        'bbox': {'io':'out'}
+        })
+        self.ctrls['color_mode'].currentIndexChanged.connect(self.changeColorMode)
+        self.ctrls['lightning'].stateChanged.connect(self.changeLightning)
+        self.ctrls['gradient'].sigGradientChangeFinished.connect(self.changeGradient)
+        # a BallPainter draws a prefix of all balls while the camera moves, so they are not sorted into chunks
+        self.stager = AttributeStager(chunk_size=None)
+
+    def changeGradient(self, gradientItem):
+        if self.pvPainter.colormap.is_initialised:
+            self.pvPainter.colormap.setImage(gradientItem.getLookupTable(nPts=self.pvPainter.colormap.width, alpha=False))
+            self.update()
+
+    def changeColorMode(self, index):
+        if self.pvPainter.program.is_initialised:
+            color_mode = ['fixed', 'texture', 'color'][index]
+            self.pvPainter.program.rebuild(color_mode=color_mode)
+
+    def changeLightning(self, state):
+        if self.pvPainter.program.is_initialised:
+            self.pvPainter.program.rebuild(lightning=state > 0)
+
+    def updateGL(self, data, image_gradient, options):
+        names, struct_arrays = data
+        self.pvPainter.program.setOptions(**options)
+        self.pvPainter.colormap.setImage(image_gradient)
+        self.setAttributes(names, struct_arrays)
+
+        if 'u_radius_scale' in self.pvPainter.program.uniforms:
+            self.pvPainter.program.setUniformValue('u_radius_scale', options['radius_scale'])
+        if 'u_color' in self.pvPainter.program.uniforms:
+            self.pvPainter.program.setUniformValue('u_color', options['color'])
+
+    def process(self, a_position, a_radius, a_color, a_intensity, bbox_clip, display=True):
+        if a_position is None or a_radius is None:
+            raise Exception('set proper inputs')
+        attributes = {'a_position':a_position, 'a_radius':a_radius, 'a_color':a_color, 'a_intensity':a_intensity}
+        attributes = dict((key, value) for key, value in attributes.items() if not value is None)
+        vertex_format = self.ctrls['vertex_format'].currentText()
+
+        changed = self.changedInputs(attributes, vertex_format, bbox_clip)
+        bbox_clip_mask = None
+        if 'a_position' in changed and bbox_clip:
+            bbox_clip_mask = bbox_clip.contains(a_position)
+        # shuffled like points, so the balls can be subsampled while the camera moves
+        struct_arrays = self.stager.stagePoints(attributes, vertex_format, bbox_clip_mask, changed)
+        self.pvPainter.vertex_ids = self.stager.rows
+
+        options = {}
+        options['radius_scale'] = self.ctrls['radius_scale'].value()
+        options['color'] = np.array(self.ctrls['color'].color(mode='float'), dtype=np.float32)
+        options['lightning'] = self.ctrls['lightning'].checkState() > 0
+        options['color_mode'] = self.ctrls['color_mode'].currentText()
+        image_gradient = self.ctrls['gradient'].getLookupTable(nPts=self.pvPainter.colormap.width, alpha=False)
+
+        self.sigUpdateGL.emit((list(attributes), struct_arrays), image_gradient, options)
+
+        if not self.pvPainter.buffer.data is None:
             bbox=self.pvPainter.getBBox()
         else:
             bbox=None
@@ -152,14 +305,17 @@ class pvLinePainterNode(pvPainterNode):
         ('wrap_mode',  'combo', {'values':['repeat', 'clamp_to_edge']}),
         ('alternate_vcolor',  'check', {'checked':True}),
         ('color',  'color', {'color':(128,128,0)}),
+        ('vertex_format',  'combo', {'values':['float', 'compact']}),
         ('gradient',  'gradient', {})
     ]
     
     def __init__(self, name):
         ## Initialize node with only a single input terminal
         pvPainterNode.__init__(self, name, draw_type='lines', terminals={
-        'start': {'io':'in', 'optional':False},
+        'start': {'io':'in'},
         'end': {'io':'in'},
+        'a_position': {'io':'in'},
+        'indices': {'io':'in'},
         'intensity': {'io':'in'},
         'color': {'io':'in'},
         'out': {'io':'out'},
@@ -196,35 +352,51 @@ class pvLinePainterNode(pvPainterNode):
             checked = state > 0
             self.pvPainter.program.rebuild(alternate_vcolor=checked)
     
-    def updateGL(self, struct_array, image_gradient, options):
+    def updateGL(self, data, image_gradient, options):
+        names, struct_arrays, indices, indices_changed = data
         self.pvPainter.program.setOptions(**options)
         self.pvPainter.colormap.setImage(image_gradient)
-        self.pvPainter.buffer.setData(struct_array)
+        self.setAttributes(names, struct_arrays)
+        if indices_changed:
+            self.setIndices(indices)
 
         if 'u_color' in self.pvPainter.program.uniforms: # should only be true if the program is initialised
             self.pvPainter.program.setUniformValue('u_color', options['color'])
 
-    def process(self, start, end, intensity, color, display=True):
-        if start is None:
+    def process(self, start, end, a_position, indices, intensity, color, display=True):
+        # either segments as start/end points, or shared vertices a_position with pairs of indices
+        if not (a_position is None or indices is None):
+            unrolled = False
+        elif not start is None:
+            a_position = (start, end)
+            unrolled = True
+            indices = None
+        else:
             raise Exception('Set Input')
 
-        m,n = start.shape
-        m *= 2
-        dtypes=[('a_position', np.float32, 3)]
-        if not intensity is None:
-            dtypes.append(('a_intensity', np.float32, 1))
-        if not color is None:
-            dtypes.append(('a_color', np.float32, 4))
-
-        struct_array = np.empty( m, dtype=dtypes )
-        struct_array['a_position'][0::2] = start
-        struct_array['a_position'][1::2] = end
-        if not intensity is None:
-            struct_array['a_intensity'][0::2] = intensity
-            struct_array['a_intensity'][1::2] = intensity
-        if not color is None:
-            struct_array['a_color'][0::2] = color
-            struct_array['a_color'][1::2] = color
+        attributes = {'a_position':a_position, 'a_intensity':intensity, 'a_color':color}
+        attributes = dict((key, value) for key, value in attributes.items() if not value is None)
+        vertex_format = self.ctrls['vertex_format'].currentText()
+
+        # only rebuild the attributes whose input changed
+        struct_arrays = {}
+        changed = self.changedInputs(dict(attributes, indices=indices), vertex_format, unrolled)
+        for key in changed:
+            if key == 'indices':
+                continue
+            dtype = vertexDtype([key], vertex_format)
+            if unrolled:
+                struct_array = self.stager.stagingArray(key, 2*len(start), dtype)
+                if key == 'a_position':
+                    struct_array[key][0::2] = start
+                    struct_array[key][1::2] = end
+                else:
+                    value = convertAttribute(attributes[key], dtype[key])
+                    struct_array[key][0::2] = value
+                    struct_array[key][1::2] = value
+            else:
+                struct_array = self.stager.stageAttribute(key, attributes[key], dtype)
+            struct_arrays[key] = struct_array
 
         options = {}
         options['color'] = np.array(self.ctrls['color'].color(mode='float'), dtype=np.float32)
@@ -232,9 +404,10 @@ class pvLinePainterNode(pvPainterNode):
         options['color_mode'] = self.ctrls['color_mode'].currentText()
         image_gradient = self.ctrls['gradient'].getLookupTable(nPts=self.pvPainter.colormap.width, alpha=False)
         
-        self.sigUpdateGL.emit(struct_array, image_gradient, options)
+        self.sigUpdateGL.emit((list(attributes), struct_arrays, indices, 'indices' in changed), image_gradient, options)
 
-        if self.pvPainter.is_initialised:
+        # batched painters are never initialised themselves
+        if not self.pvPainter.buffer.data is None:
             bbox=self.pvPainter.getBBox()
         else:
             bbox=None
@@ -252,7 +425,8 @@ class pvTrianglePainterNode(pvPainterNode):
         # ('draw_mode',  'combo', {'values':['lines', 'triangles']}),
         ('color',  'color', {'color':(128,128,0)}),
         ('lightning',  'check', {'checked':True}),
-        ('wireframe',  'check', {'checked':False})#,
+        ('wireframe',  'check', {'checked':False}),
+        ('vertex_format',  'combo', {'values':['float', 'compact']})#,
         # ('gradient',  'gradient', {})
     ]
     
@@ -261,6 +435,7 @@ class pvTrianglePainterNode(pvPainterNode):
         pvPainterNode.__init__(self, name, draw_type='triangles', terminals={
         'a_position': {'io':'in', 'optional':False},
         'a_normal': {'io':'in'},
+        'indices': {'io':'in'},
         # 'intensity': {'io':'in'},
         'out': {'io':'out'},
         'bbox': {'io':'out'}
@@ -294,33 +469,46 @@ class pvTrianglePainterNode(pvPainterNode):
             checked = state > 0
             self.pvPainter.draw_polywire = checked
 
-    def updateGL(self, struct_array, image_gradient, options):
+    def updateGL(self, data, image_gradient, options):
+        names, struct_arrays, indices, indices_changed = data
         self.pvPainter.program.setOptions(**options)
         # self.pvPainter.colormap.setImage(image_gradient)
-        self.pvPainter.buffer.setData(struct_array)
+        self.setAttributes(names, struct_arrays)
+        if indices_changed:
+            self.setIndices(indices)
 
         if 'u_color' in self.pvPainter.program.uniforms: # should only be true if the program is initialised
             self.pvPainter.program.setUniformValue('u_color', options['color'])
 
-    def process(self, a_position, a_normal, display=True):
+    def process(self, a_position, a_normal, indices, display=True):
+        # a_position holds either unrolled triangles, or shared vertices that are indexed by indices
         if a_position is None:
             raise Exception('Set Input')
 
         m,n = a_position.shape
-        dtypes=[('a_position', np.float32, 3)]
-        if not a_normal is None:
-            dtypes.append(('a_normal', np.float32, 3))
-        # if not intensity is None:
-        #     dtypes.append(('a_intensity', np.float32, 1))
-
-        struct_array = np.empty( m, dtype=dtypes )
-        struct_array['a_position'] = a_position
-        if not a_normal is None:
-            struct_array['a_normal'][0::3] = a_normal
-            struct_array['a_normal'][1::3] = a_normal
-            struct_array['a_normal'][2::3] = a_normal
-        # if not intensity is None:
-        #     struct_array['a_intensity'] = intensity
+        attributes = {'a_position':a_position, 'a_normal':a_normal}
+        # attributes['a_intensity'] = intensity
+        attributes = dict((key, value) for key, value in attributes.items() if not value is None)
+        vertex_format = self.ctrls['vertex_format'].currentText()
+
+        # only rebuild the attributes whose input changed
+        struct_arrays = {}
+        changed = self.changedInputs(dict(attributes, indices=indices), vertex_format, m)
+        for key in changed:
+            if key == 'indices':
+                continue
+            dtype = vertexDtype([key], vertex_format)
+            value = convertAttribute(attributes[key], dtype[key])
+            struct_array = self.stager.stagingArray(key, m, dtype)
+            if len(value) == m:
+                # a value per vertex
+                struct_array[key] = value
+            else:
+                # a value per unrolled triangle
+                struct_array[key][0::3] = value
+                struct_array[key][1::3] = value
+                struct_array[key][2::3] = value
+            struct_arrays[key] = struct_array
 
         options = {}
         options['color'] = np.array(self.ctrls['color'].color(mode='float'), dtype=np.float32)
@@ -329,9 +517,10 @@ class pvTrianglePainterNode(pvPainterNode):
         # options['wireframe'] = self.ctrls['wireframe'].checkState() > 0
         # image_gradient = self.ctrls['gradient'].getLookupTable(nPts=self.pvPainter.colormap.width, alpha=False)
         image_gradient=None
-        self.sigUpdateGL.emit(struct_array, image_gradient, options)
+        self.sigUpdateGL.emit((list(attributes), struct_arrays, indices, 'indices' in changed), image_gradient, options)
 
-        if self.pvPainter.is_initialised:
+        # batched painters are never initialised themselves
+        if not self.pvPainter.buffer.data is None:
             bbox=self.pvPainter.getBBox()
         else:
             bbox=None
@@ -399,15 +588,32 @@ class pvWindowNode(CtrlNode):
         CtrlNode.__init__(self, name, terminals={
         'layers': {'io':'in', 'multi':True},
         'plot_layers': {'io':'in', 'multi':True},
-        'bbox': {'io':'in'}
+        'bbox': {'io':'in'},
+        'picked': {'io':'out'},
+        'ma_idx': {'io':'out'}
         })
+        self.picked = None
+        self.ma_idx = None
 
-    def setPyViWindow(self, window, plotwindow):
+    def setPyViWindow(self, window, plotwindow=None):
         self.pvWindow = window
         self.pvPlotWindow = plotwindow
         self.sigLayerUpdated.connect(window.setLayer)
-        self.sigPlotLayerUpdated.connect(plotwindow.setLayer)
+        if not plotwindow is None:
+            self.sigPlotLayerUpdated.connect(plotwindow.setLayer)
+        window.sigPicked.connect(self.setPicked)
         self.update()
+
+    def setPicked(self, result):
+        """Output the painter and the index of the point picked in the window"""
+        if result is None:
+            self.picked = self.ma_idx = None
+        else:
+            painter, index = result
+            self.picked = painter
+            # same format as the idx output of pvBBoxNode
+            self.ma_idx = np.array([index]), 's'
+        self.setOutput(picked=self.picked, ma_idx=self.ma_idx)
     
     def setWidgetPane(self, widget):
         self.widgetPane = widget
@@ -437,4 +643,9 @@ class pvWindowNode(CtrlNode):
         # self.pvWindow.p_fov = self.ctrls['fov'].value()
 
         self.pvWindow.setBBox(bbox)
-        self.pvWindow.renderLater()
\ No newline at end of file
+        self.pvWindow.renderLater()
+
+        return {
+            'picked': self.picked,
+            'ma_idx': self.ma_idx
+        }
\ No newline at end of file
@@ -9,6 +9,68 @@ from skel3d.io import npy
 from skel3d.clustering import get_clusters, classify_cluster, CLASSDICT
 
 import numpy as np
+import os
+from collections.abc import MutableMapping
+
+class LazyDataDict(MutableMapping):
+    """Dataset directory as a dict that opens arrays on first access. npy files are memory-mapped
+    read-only, so only the pages that are actually used get read. Object arrays and other files are read
+    completely with npy.read on first access, they are not memory-mapped."""
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        for fname in sorted(os.listdir(path)):
+            key, ext = os.path.splitext(fname)
+            if not fname.startswith('.') and (ext == '.npy' or not key in self.files):
+                self.files[key] = fname
+        self.loaded = {}
+        # key -> function applied to the array of key on first access
+        self.derived = {}
+
+    def derive(self, key, function):
+        """Apply function (eg a type conversion) to the array of key when it is first accessed"""
+        self.derived[key] = function
+
+    def __getitem__(self, key):
+        if not key in self.loaded:
+            if not key in self.files:
+                raise KeyError(key)
+            value = self.load(key)
+            if key in self.derived:
+                value = self.derived[key](value)
+            self.loaded[key] = value
+        return self.loaded[key]
+
+    def load(self, key):
+        fname = self.files[key]
+        if fname.endswith('.npy'):
+            try:
+                return np.load(os.path.join(self.path, fname), mmap_mode='r')
+            except ValueError:
+                # object arrays can not be memory-mapped
+                pass
+        # read completely
+        return npy.read(self.path, [key])[key]
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+
+    def __delitem__(self, key):
+        if not key in self.loaded and not key in self.files:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.files.pop(key, None)
+
+    def __contains__(self, key):
+        # without opening the file
+        return key in self.loaded or key in self.files
+
+    def __iter__(self):
+        keys = list(self.files)
+        return iter(keys + [key for key in self.loaded if not key in self.files])
+
+    def __len__(self):
+        return len(set(self.files) | set(self.loaded))
 
 class maReaderNode(Node):
     nodeName = 'maReader'
@@ -27,7 +89,7 @@ class maReaderNode(Node):
         })
 
     def process(self, path, display=True):
-        datadict = npy.read(path)
+        datadict = LazyDataDict(path)
         # mah = MAHelper(datadict)
         # data_arrays = {}
         # for key in mah.arrays: data_arrays[key] = mah.D[key]
@@ -46,7 +108,11 @@ class maReaderNode(Node):
         if 'colors' in datadict:
             colors = datadict['colors']
         if 'seg_link_flip' in datadict:
-            seg_link_flip = datadict['seg_link_flip'].astype(np.int32)
+            # converted on first access, without a copy if it is stored as int32
+            datadict.derive('seg_link_flip', lambda a: a.astype(np.int32, copy=False))
+            # only read if a node uses it, see connected()
+            if self.terminals['seg_link_flip'].isConnected():
+                seg_link_flip = datadict['seg_link_flip']
         if 'ma_segment_lidx' in datadict:
             ma_segment_lidx = datadict['ma_segment_lidx']
 
@@ -61,6 +127,11 @@ class maReaderNode(Node):
             'ma_segment_lidx': ma_segment_lidx
         }
 
+    def connected(self, localTerm, remoteTerm):
+        # seg_link_flip is only read while its output is connected
+        if localTerm is self.terminals['seg_link_flip'] and not self.terminals['path'].value() is None:
+            self.update()
+
 class maWriterNode(Node):
     nodeName = 'maWriter'
 
@@ -4,7 +4,7 @@ from PyQt5 import QtCore
 
 from pyvi.gloo import *
 from pyvi.util import *
-from pyvi.shaders import PointShaderProgram, LineShaderProgram, TriangleShaderProgram
+from pyvi.shaders import PointShaderProgram, LineShaderProgram, TriangleShaderProgram, BallShaderProgram
 
 
 class pvPainterNode(CtrlNode):
@@ -22,10 +22,24 @@ class pvPainterNode(CtrlNode):
             shader = LineShaderProgram()
         elif draw_type == 'triangles':
             shader = TriangleShaderProgram()
+        elif draw_type == 'balls':
+            shader = BallShaderProgram()
         buffer = Buffer()
-        colormap = ColorMap()
-        self.pvPainter = Painter(shader, draw_type, buffer, colormap)
+        self.pvPainter = self.createPainter(shader, draw_type, buffer, ColorMap())
         self.pvPainter.name = self.name
+        # created by the first setIndices
+        self.index_buffer = None
+        # one buffer per vertex attribute, so an attribute can be replaced without touching the others
+        self.attribute_buffers = {'a_position': buffer}
+        self.last_inputs = {}
+        # struct arrays that are filled again on the next process() if they still fit
+        self.stager = AttributeStager()
+
+    def createPainter(self, shader, draw_type, buffer, colormap):
+        if draw_type == 'balls':
+            return BallPainter(shader, buffer, colormap)
+        # large datasets are split into chunks that are culled against the view frustum
+        return ChunkedPainter(shader, draw_type, buffer, colormap)
 
     def renamed(self, old_name):
         self.update()
@@ -33,8 +47,46 @@ class pvPainterNode(CtrlNode):
     def updateGL(self, struct_array, image_gradient, options):
         pass
 
+    def changedInputs(self, inputs, *state):
+        """Return the names of inputs that are not the same objects as in the previous call, or all names if state
+        (eg the vertex format or clipping box) changed. Arrays that are modified in place are not detected."""
+        def same(a, b):
+            if type(a) is tuple and type(b) is tuple:
+                return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+            return a is b
+        state_changed = state != self.last_inputs.get(None)
+        changed = []
+        for name, value in inputs.items():
+            if state_changed or not name in self.last_inputs or not same(self.last_inputs[name], value):
+                changed.append(name)
+        self.last_inputs = dict(inputs)
+        self.last_inputs[None] = state
+        return changed
+
+    def setAttributes(self, names, struct_arrays):
+        """Upload the single field struct_arrays to their attribute buffers and draw from the buffers of names"""
+        for name, struct_array in struct_arrays.items():
+            if not name in self.attribute_buffers:
+                self.attribute_buffers[name] = Buffer()
+            self.attribute_buffers[name].setData(struct_array)
+        self.pvPainter.setBuffers([self.attribute_buffers[name] for name in VERTEX_ATTRIBUTES if name in names])
+
+    def setIndices(self, indices, n_vertices=None):
+        if n_vertices is None:
+            n_vertices = len(self.attribute_buffers['a_position'].data)
+        if indices is None:
+            self.pvPainter.setIndexBuffer(None)
+        else:
+            if self.index_buffer is None:
+                self.index_buffer = IndexBuffer()
+            self.index_buffer.setIndices(indices, n_vertices)
+            self.pvPainter.setIndexBuffer(self.index_buffer)
+
     def destroy(self, node):
-        self.pvPainter.buffer.delete()
+        for buffer in self.attribute_buffers.values():
+            buffer.delete()
+        if not self.index_buffer is None:
+            self.index_buffer.delete()
         self.pvPainter.colormap.delete()
         self.pvPainter.program.delete()
         self.pvPainter.delete()
\ No newline at end of file
@@ -0,0 +1,3 @@
+"""Rendering benchmarks on synthetic datasets, run them with the bench script"""
+from .datasets import points, lines, mesh
+from .runner import benchmarkPoints, benchmarkLines, benchmarkMesh, runBenchmarks, compareResults
@@ -0,0 +1,52 @@
+import numpy as np
+
+# rows generated at a time, bounds the temporary memory for large datasets
+BLOCK_SIZE = 2**22
+
+def points(n, seed=0):
+    """n points on a noisy unit sphere, as the a_position, a_normal, a_color and a_intensity inputs of
+    pvPointPainter"""
+    rng = np.random.RandomState(seed)
+    attributes = {
+        'a_position': np.empty((n, 3), dtype=np.float32),
+        'a_normal': np.empty((n, 3), dtype=np.float32),
+        'a_color': np.empty((n, 4), dtype=np.float32),
+        'a_intensity': np.empty(n, dtype=np.float32)
+    }
+    for start in range(0, n, BLOCK_SIZE):
+        end = min(n, start+BLOCK_SIZE)
+        normal = rng.standard_normal((end-start, 3))
+        normal /= np.linalg.norm(normal, axis=1)[:,None]
+        attributes['a_normal'][start:end] = normal
+        attributes['a_position'][start:end] = normal * (1 + 0.01*rng.standard_normal((end-start, 1)))
+        attributes['a_color'][start:end,:3] = np.abs(normal)
+        attributes['a_color'][start:end,3] = 1
+        attributes['a_intensity'][start:end] = (normal[:,2]+1)/2
+    return attributes
+
+def lines(n, seed=0):
+    """n short segments starting on a unit sphere, as the start, end and intensity inputs of pvLinePainter"""
+    p = points(n, seed)
+    start = p['a_position']
+    end = start + 0.02*p['a_normal']
+    return {'start': start, 'end': end, 'intensity': p['a_intensity']}
+
+def mesh(n, seed=0):
+    """Wavy height field of about n vertices, as the a_position, a_normal and indices inputs of pvTrianglePainter"""
+    rng = np.random.RandomState(seed)
+    side = max(2, int(np.sqrt(n)))
+    x, y = np.meshgrid(np.linspace(-1, 1, side, dtype=np.float32), np.linspace(-1, 1, side, dtype=np.float32))
+    phase = rng.uniform(0, 2*np.pi, 2)
+    z = 0.1*np.sin(8*x + phase[0])*np.cos(8*y + phase[1])
+    a_position = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1).astype(np.float32)
+    # normal of the height field from its gradient
+    dzdx = 0.8*np.cos(8*x + phase[0])*np.cos(8*y + phase[1])
+    dzdy = -0.8*np.sin(8*x + phase[0])*np.sin(8*y + phase[1])
+    a_normal = np.stack([-dzdx.ravel(), -dzdy.ravel(), np.ones(side*side)], axis=1)
+    a_normal = (a_normal / np.linalg.norm(a_normal, axis=1)[:,None]).astype(np.float32)
+
+    corner = (np.arange(side-1)[:,None]*side + np.arange(side-1)[None,:]).ravel()
+    indices = np.empty((len(corner), 2, 3), dtype=np.uint32)
+    indices[:,0] = np.stack([corner, corner+1, corner+side], axis=1)
+    indices[:,1] = np.stack([corner+1, corner+side+1, corner+side], axis=1)
+    return {'a_position': a_position, 'a_normal': a_normal, 'indices': indices.reshape(-1, 3)}
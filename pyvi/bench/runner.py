@@ -0,0 +1,204 @@
+import time
+import platform
+import datetime
+import itertools
+import tracemalloc
+
+import numpy as np
+from OpenGL import GL as gl
+
+from ..gloo import *
+from ..linalg import quaternion as q
+from ..util import BBox
+from ..shaders import PointShaderProgram, LineShaderProgram, TriangleShaderProgram
+from ..window import OffscreenWindow
+from . import datasets
+
+# every combination of the PointShaderProgram options that change the shaders
+POINT_OPTIONS = [{'draw_mode': draw_mode, 'color_mode': color_mode, 'lightning': lightning}
+    for draw_mode, color_mode, lightning in itertools.product(['simple', 'disk', 'oriented_disk'], ['fixed', 'texture', 'color'], [False, True])]
+
+# camera rotation per frame while measuring the frame rate
+FRAME_ROTATION = q.quaternion(0.01, (0., 1., 0.))
+
+def stageAttributes(attributes, draw_type, vertex_format='float', mask=None):
+    """One struct array per attribute, staged as the painter nodes stage them: points (shuffled, clipped to mask
+    and sorted into chunks) with AttributeStager.stagePoints and lines and triangles attribute by attribute"""
+    stager = AttributeStager()
+    if draw_type == 'points':
+        return stager.stagePoints(attributes, vertex_format, mask)
+    return dict((name, stager.stageAttribute(name, value, vertexDtype([name], vertex_format))) for name, value in attributes.items())
+
+def uploadBuffers(struct_arrays):
+    """Buffers of struct_arrays in the order painters take them, and the seconds it took to upload them"""
+    start = time.perf_counter()
+    buffers = {}
+    for name, struct_array in struct_arrays.items():
+        buffers[name] = Buffer(struct_array)
+        buffers[name].initialise()
+    gl.glFinish()
+    return buffers, time.perf_counter() - start
+
+def renderPainter(window, painter, frames):
+    """Seconds to compile and link the program of painter, seconds until the first frame with painter is
+    complete after that, and the frames per second after the first frame"""
+    layer = Layer()
+    layer.name = lambda: 'bench'
+    painter.name = lambda: 'bench'
+    painter.is_visible = True
+    layer.setPainter(painter)
+    window.setLayer(layer)
+    window.framebuffer.bind()
+
+    # the program is evicted from PROGRAM_CACHE afterwards, so every case compiles and the first frames compare
+    start = time.perf_counter()
+    painter.program.initialise()
+    gl.glFinish()
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    window.renderFrames()
+    gl.glFinish()
+    first_frame = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(frames):
+        window.v_rotation = q.product(FRAME_ROTATION, window.v_rotation)
+        window.render()
+    gl.glFinish()
+    fps = frames / (time.perf_counter() - start)
+
+    window.unsetLayer(layer)
+    painter.delete()
+    linked = painter.program.linked
+    painter.program.delete()
+    PROGRAM_CACHE.discard(linked)
+    return compile_time, first_frame, fps
+
+def benchmarkCase(window, kind, n, attributes, programs, draw_type, vertex_format, frames, indices=None, mask=None):
+    # the peak of the memory allocated by this case, the process peak would include the previous cases
+    tracemalloc.start()
+    start = time.perf_counter()
+    struct_arrays = stageAttributes(attributes, draw_type, vertex_format, mask)
+    build = time.perf_counter() - start
+
+    window.makeCurrent()
+    buffers, upload = uploadBuffers(struct_arrays)
+    index_buffer = None
+    if not indices is None:
+        index_buffer = IndexBuffer(indices, len(attributes['a_position']))
+        index_buffer.initialise()
+    # stopped before rendering, tracing would slow down the frames
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    gpu_bytes = sum(buffer.capacity for buffer in buffers.values())
+    if not index_buffer is None:
+        gpu_bytes += index_buffer.capacity
+
+    results = []
+    for options, program in programs:
+        names = ['a_position'] + [name for name in program.attribute_names if name != 'a_position']
+        painter = ChunkedPainter(program, draw_type, buffers['a_position'], ColorMap())
+        painter.setBuffers([buffers[name] for name in names if name in buffers])
+        painter.setIndexBuffer(index_buffer)
+        compile_time, first_frame, fps = renderPainter(window, painter, frames)
+        painter.colormap.delete()
+        painter.chunk_index_buffer.delete()
+        results.append({
+            'kind': kind,
+            'n': n,
+            'vertex_format': vertex_format,
+            'clip': not mask is None,
+            'options': options,
+            'build_s': build,
+            'upload_s': upload,
+            'compile_s': compile_time,
+            'first_frame_s': first_frame,
+            'fps': fps,
+            'gpu_bytes': gpu_bytes,
+            'peak_memory_bytes': peak_memory
+        })
+
+    for buffer in buffers.values():
+        buffer.delete()
+    if not index_buffer is None:
+        index_buffer.delete()
+    return results
+
+def benchmarkPoints(window, n, vertex_format='float', frames=30, options=POINT_OPTIONS, clip=False):
+    """With clip, only the points in the upper half of their bounding box are staged, as with the bbox_clip
+    input of the point painter node"""
+    attributes = datasets.points(n)
+    mask = None
+    if clip:
+        bbox = BBox(attributes['a_position'])
+        mi = bbox.mi.copy()
+        mi[2] = bbox.center[2]
+        mask = BBox(np.array([mi, bbox.ma])).contains(attributes['a_position'])
+    programs = [(o, PointShaderProgram(**o)) for o in options]
+    return benchmarkCase(window, 'points', n, attributes, programs, 'points', vertex_format, frames, mask=mask)
+
+def benchmarkLines(window, n, vertex_format='float', frames=30):
+    segments = datasets.lines(n)
+    a_position = np.empty((2*n, 3), dtype=np.float32)
+    a_position[0::2], a_position[1::2] = segments['start'], segments['end']
+    attributes = {'a_position': a_position, 'a_intensity': np.repeat(segments['intensity'], 2)}
+    options = [{'color_mode': 'fixed'}, {'color_mode': 'texture'}]
+    programs = [(o, LineShaderProgram(**o)) for o in options]
+    return benchmarkCase(window, 'lines', n, attributes, programs, 'lines', vertex_format, frames)
+
+def benchmarkMesh(window, n, vertex_format='float', frames=30):
+    triangles = datasets.mesh(n)
+    attributes = {'a_position': triangles['a_position'], 'a_normal': triangles['a_normal']}
+    options = [{'lightning': False}, {'lightning': True}]
+    programs = [(o, TriangleShaderProgram(**o)) for o in options]
+    return benchmarkCase(window, 'mesh', n, attributes, programs, 'triangles', vertex_format, frames, triangles['indices'])
+
+def runBenchmarks(sizes, kinds=('points', 'lines', 'mesh'), vertex_format='float', frames=30, size=(800, 800), progress=None, clip=False):
+    """Run the benchmarks of kinds for each number of points in sizes in an OffscreenWindow, with clip the points
+    are clipped as in benchmarkPoints. Returns a json serialisable dict with the results and a description of
+    the system."""
+    benchmarks = {'points': benchmarkPoints, 'lines': benchmarkLines, 'mesh': benchmarkMesh}
+    window = OffscreenWindow(size=size)
+    window.makeCurrent()
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'gl_vendor': gl.glGetString(gl.GL_VENDOR).decode(),
+        'gl_renderer': gl.glGetString(gl.GL_RENDERER).decode(),
+        'gl_version': gl.glGetString(gl.GL_VERSION).decode(),
+        'window_size': list(size),
+        'frames': frames,
+        'results': []
+    }
+    for kind in kinds:
+        for n in sizes:
+            if not progress is None:
+                progress(kind, n)
+            if kind == 'points':
+                report['results'] += benchmarkPoints(window, n, vertex_format, frames, clip=clip)
+            else:
+                report['results'] += benchmarks[kind](window, n, vertex_format, frames)
+    window.delete()
+    return report
+
+def resultKey(result):
+    # reports without clip were not clipped
+    return result['kind'], result['n'], result['vertex_format'], result.get('clip', False), tuple(sorted(result['options'].items()))
+
+def compareResults(old, new):
+    """Ratios new/old of the measurements of the benchmarks in both reports, as a list of (key, {measurement: ratio})"""
+    old_results = dict((resultKey(result), result) for result in old['results'])
+    comparison = []
+    for result in new['results']:
+        key = resultKey(result)
+        if not key in old_results:
+            continue
+        ratios = {}
+        for name, value in result.items():
+            old_value = old_results[key].get(name)
+            if name.endswith(('_s', '_bytes')) or name == 'fps':
+                ratios[name] = value / old_value if old_value else None
+        comparison.append((key, ratios))
+    return comparison
@@ -1,18 +1,516 @@
 from OpenGL import GL as gl
+from OpenGL import contextdata, error
 import numpy as np
 import ctypes
+import hashlib
+import os
+import sys
+import warnings
 
-from .util import BBox
+from .util import BBox, frustumPlanes, boxesInFrustum
 
-DRAW_TYPES = {'points':gl.GL_POINTS, 'lines':gl.GL_LINES, 'triangles':gl.GL_TRIANGLES, 'line_strip':gl.GL_LINE_STRIP, 'line_loop':gl.GL_LINE_LOOP}
+# how long to block on a fence before checking again, in nanoseconds
+FENCE_TIMEOUT = 1000000000
+
+DRAW_TYPES = {'points':gl.GL_POINTS, 'lines':gl.GL_LINES, 'triangles':gl.GL_TRIANGLES, 'line_strip':gl.GL_LINE_STRIP, 'line_loop':gl.GL_LINE_LOOP, 'triangle_strip':gl.GL_TRIANGLE_STRIP}
 SHADER_TYPES = { 'vertex':gl.GL_VERTEX_SHADER, 'fragment':gl.GL_FRAGMENT_SHADER }
 
+# unit vectors packed into a signed normalized 10_10_10_2 word, see packNormals
+PACKED_NORMAL = np.dtype(np.uint32, metadata={'gl_type':gl.GL_INT_2_10_10_10_REV, 'gl_size':4})
+
+GL_TYPES = {
+    np.dtype(np.float32): gl.GL_FLOAT,
+    np.dtype(np.float16): gl.GL_HALF_FLOAT,
+    np.dtype(np.int8): gl.GL_BYTE,
+    np.dtype(np.uint8): gl.GL_UNSIGNED_BYTE,
+    np.dtype(np.int16): gl.GL_SHORT,
+    np.dtype(np.uint16): gl.GL_UNSIGNED_SHORT,
+    np.dtype(np.int32): gl.GL_INT,
+    np.dtype(np.uint32): gl.GL_UNSIGNED_INT
+}
+
+def attribFormat(dtype):
+    """Return (size, gl_type, normalized) for a vertex attribute stored as numpy dtype (a struct array field).
+    Integer attributes are normalized, so shaders read them as floats in [0,1] or [-1,1]"""
+    base = dtype.base
+    if base.metadata and 'gl_type' in base.metadata:
+        return base.metadata['gl_size'], base.metadata['gl_type'], True
+    if not base in GL_TYPES:
+        raise TypeError("Unsupported vertex attribute type '{}'".format(base))
+    size = int(np.prod(dtype.shape))
+    return size, GL_TYPES[base], base.kind in 'iu'
+
+def packNormals(normals):
+    """Pack an n x 3 array of unit vectors into GL_INT_2_10_10_10_REV words"""
+    q = np.round(np.clip(normals, -1., 1.)*511).astype(np.int32) & 0x3ff
+    return (q[:,0] | (q[:,1]<<10) | (q[:,2]<<20)).astype(np.uint32)
+
+def convertAttribute(value, dtype):
+    """Convert float attribute values to the vertex format dtype, integers are scaled to their normalized range"""
+    value = np.asarray(value)
+    base = dtype.base
+    if base.metadata and 'gl_type' in base.metadata:
+        return packNormals(value)
+    elif base.kind in 'iu' and value.dtype.kind == 'f':
+        lo = -1. if base.kind == 'i' else 0.
+        return np.round(np.clip(value, lo, 1.)*np.iinfo(base).max)
+    return value
+
+# numpy formats of the vertex attributes, 'compact' trades precision for memory. A point with position, normal
+# and color takes 20 bytes in 'compact' (40 in 'float'): positions stay float32, as half floats lose
+# centimetres on datasets of a few hundred metres and quantized positions would need an offset and scale in every
+# shader and wherever staged positions are read (bounding boxes, chunk culling, picking)
+VERTEX_FORMATS = {
+    'float': {
+        'a_position': (np.float32, 3),
+        'a_normal': (np.float32, 3),
+        'a_color': (np.float32, 4),
+        'a_intensity': (np.float32,),
+        'a_radius': (np.float32,)
+    },
+    'compact': {
+        'a_position': (np.float32, 3),
+        'a_normal': (PACKED_NORMAL,),
+        'a_color': (np.uint8, 4),
+        'a_intensity': (np.float16,),
+        'a_radius': (np.float16,)
+    }
+}
+# field order, keeps the 4 byte attributes aligned in compact formats
+VERTEX_ATTRIBUTES = ['a_position', 'a_normal', 'a_color', 'a_intensity', 'a_radius']
+
+def vertexDtype(names, vertex_format='float'):
+    formats = VERTEX_FORMATS[vertex_format]
+    return np.dtype([(name,)+formats[name] for name in VERTEX_ATTRIBUTES if name in names], align=True)
+
+# primitives per spatial chunk of a ChunkedPainter
+CHUNK_SIZE = 2**16
+
+def chunkCells(points, bbox, chunk_size=CHUNK_SIZE):
+    """Grid cell of each of the points, on a grid over bbox with about chunk_size points per cell"""
+    cells = max(1, int(round((len(points) / float(chunk_size)) ** (1/3.))))
+    cell_scale = (cells / np.maximum(bbox.width, 1e-12)).astype(points.dtype)
+    ijk = ((points - bbox.mi.astype(points.dtype)) * cell_scale).astype(np.int64)
+    np.clip(ijk, 0, cells-1, out=ijk)
+    return (ijk[:,0]*cells + ijk[:,1])*cells + ijk[:,2]
+
+def chunkOrder(positions, chunk_size=CHUNK_SIZE):
+    """Stable order that sorts points into the spatial chunks of a ChunkedPainter, or None if they fit in one
+    chunk. Points stored in this order are drawn as ranges of the vertex buffers, without an index buffer."""
+    if len(positions) <= chunk_size:
+        return None
+    return np.argsort(chunkCells(positions, BBox(positions), chunk_size), kind='stable')
+
+class AttributeStager(object):
+    """Stages vertex attributes into single field struct arrays for upload, the arrays of the previous call
+    are filled again if they still fit. Points are sorted into chunks of chunk_size (see chunkOrder), or not
+    at all if it is None."""
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        # attribute name -> struct array
+        self.arrays = {}
+        # random permutation the points are staged in, see shuffleOrder
+        self.shuffle_order = None
+        # input row of each staged point, uint32 unless there are 2**32 or more, see stagePoints
+        self.rows = None
+
+    def stagingArray(self, name, n, dtype):
+        """Return a length n struct array of dtype for attribute name, reusing the storage of the previous call when it fits"""
+        staging = self.arrays.get(name)
+        if staging is None or staging.dtype != dtype or not n <= len(staging) <= 2*n:
+            staging = np.empty(n, dtype=dtype)
+            self.arrays[name] = staging
+        return staging[:n]
+
+    def shuffleOrder(self, n):
+        """Fixed random permutation of n rows, staging all attributes in this order makes any prefix of the
+        buffers a uniform sample, which is what is drawn while the camera moves"""
+        if self.shuffle_order is None or len(self.shuffle_order) != n:
+            index_type = np.uint32 if n < 2**32 else np.int64
+            self.shuffle_order = np.random.RandomState(0).permutation(n).astype(index_type)
+        return self.shuffle_order
+
+    def stageAttribute(self, name, value, dtype, rows=None):
+        """Copy value, or only its rows if given, into the staging array of attribute name"""
+        value = np.asarray(value)
+        struct_array = self.stagingArray(name, len(value) if rows is None else len(rows), dtype)
+        base = dtype[name].base
+        if rows is None:
+            struct_array[name] = convertAttribute(value, dtype[name])
+        elif value.dtype == base and not (base.metadata and 'gl_type' in base.metadata):
+            # gathered straight into the staging array, the rows are valid so clip skips the bounds check
+            np.take(value, rows, axis=0, out=struct_array[name], mode='clip')
+        else:
+            struct_array[name] = convertAttribute(np.take(value, rows, axis=0), dtype[name])
+        return struct_array
+
+    def pointRows(self, a_position, mask=None):
+        """Rows of a_position that are staged as points: those selected by mask (all if None) in shuffled order"""
+        if mask is None:
+            return self.shuffleOrder(len(a_position))
+        selected = np.flatnonzero(mask)
+        return selected.astype(self.shuffleOrder(len(selected)).dtype)[self.shuffle_order]
+
+    def stagePoints(self, attributes, vertex_format='float', mask=None, changed=None):
+        """Stage the points in attributes (name -> array, with at least a_position) that are selected by mask,
+        see pointRows, sorted into chunks. Within a chunk the points stay shuffled, so a prefix of each chunk is
+        a uniform sample of it. Only the attributes named in changed are staged (all if None), the rows and mask
+        are only computed again if a_position is one of them. When the staged rows change all attributes are
+        staged, so every buffer holds the same points. Returns name -> struct array of the staged attributes,
+        the input row of each staged point is in self.rows."""
+        if changed is None:
+            changed = list(attributes)
+        struct_arrays = {}
+        if 'a_position' in changed or self.rows is None:
+            rows = self.pointRows(attributes['a_position'], mask)
+            positions = self.stageAttribute('a_position', attributes['a_position'], vertexDtype(['a_position'], vertex_format), rows)
+            # sorted on the staged values, the painter finds the same chunks in them
+            order = None if self.chunk_size is None else chunkOrder(positions['a_position'], self.chunk_size)
+            if not order is None:
+                rows = rows[order]
+                positions['a_position'] = positions['a_position'][order]
+            struct_arrays['a_position'] = positions
+            if self.rows is None or not (rows is self.rows or np.array_equal(rows, self.rows)):
+                changed = list(attributes)
+            self.rows = rows
+        for name in changed:
+            if not name in struct_arrays:
+                struct_arrays[name] = self.stageAttribute(name, attributes[name], vertexDtype([name], vertex_format), self.rows)
+        return struct_arrays
+
+def currentContext():
+    """The current GL context, or None if no context is current"""
+    try:
+        return contextdata.getContext()
+    except error.Error:
+        return None
+
+def hasExtension(name):
+    n = gl.glGetIntegerv(gl.GL_NUM_EXTENSIONS)
+    for i in range(n):
+        extension = gl.glGetStringi(gl.GL_EXTENSIONS, i)
+        if extension.decode() == name:
+            return True
+    return False
+
+class GLState(object):
+    """Cache of the bindings of one GL context, so binds of what is already bound are skipped.
+    Bindings are left in place after use instead of being reset to 0, code that changes them
+    directly should call invalidate(). The element array binding is VAO state and is not tracked."""
+    def __init__(self):
+        self.issued = 0
+        self.skipped = 0
+        self.invalidate()
+
+    def invalidate(self):
+        self.program = None
+        self.vertex_array = None
+        self.buffers = {} # target -> buffer
+        self.indexed_buffers = {} # (target, index) -> buffer
+        self.active_texture = None
+        self.textures = {} # (unit, target) -> texture
+
+    def resetCounters(self):
+        self.issued = 0
+        self.skipped = 0
+
+    def useProgram(self, program):
+        if self.program == program:
+            self.skipped += 1
+            return
+        gl.glUseProgram(program)
+        self.program = program
+        self.issued += 1
+
+    def bindVertexArray(self, vertex_array):
+        if self.vertex_array == vertex_array:
+            self.skipped += 1
+            return
+        gl.glBindVertexArray(vertex_array)
+        self.vertex_array = vertex_array
+        self.issued += 1
+
+    def bindBuffer(self, target, buffer):
+        if self.buffers.get(target) == buffer:
+            self.skipped += 1
+            return
+        gl.glBindBuffer(target, buffer)
+        self.buffers[target] = buffer
+        self.issued += 1
+
+    def bindBufferBase(self, target, index, buffer):
+        if self.indexed_buffers.get((target, index)) == buffer:
+            self.skipped += 1
+            return
+        gl.glBindBufferBase(target, index, buffer)
+        # also binds the generic binding point
+        self.indexed_buffers[(target, index)] = buffer
+        self.buffers[target] = buffer
+        self.issued += 1
+
+    def bindTexture(self, target, texture, unit=0):
+        if self.textures.get((unit, target)) == texture:
+            self.skipped += 1
+            return
+        if self.active_texture != unit:
+            gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+            self.active_texture = unit
+            self.issued += 1
+        gl.glBindTexture(target, texture)
+        self.textures[(unit, target)] = texture
+        self.issued += 1
+
+    # deleting a bound object resets its bindings, and its name may be handed out again
+
+    def deleteProgram(self, program):
+        gl.glDeleteProgram(program)
+        if self.program == program:
+            self.program = None
+
+    def deleteVertexArray(self, vertex_array):
+        gl.glDeleteVertexArrays(1, gl.GLuint(vertex_array))
+        if self.vertex_array == vertex_array:
+            self.vertex_array = None
+
+    def deleteBuffer(self, buffer):
+        gl.glDeleteBuffers(1, gl.GLuint(buffer))
+        self.buffers = dict((k, v) for k, v in self.buffers.items() if v != buffer)
+        self.indexed_buffers = dict((k, v) for k, v in self.indexed_buffers.items() if v != buffer)
+
+    def deleteTexture(self, texture):
+        gl.glDeleteTextures(1, gl.GLuint(texture))
+        self.textures = dict((k, v) for k, v in self.textures.items() if v != texture)
+
+GL_STATES = {} # context -> GLState
+_current_state = [None]
+
+def makeStateCurrent():
+    """Select the GLState of the current context, to be called after making a context current"""
+    context = contextdata.getContext()
+    if not context in GL_STATES:
+        GL_STATES[context] = GLState()
+    _current_state[0] = GL_STATES[context]
+    return _current_state[0]
+
+def forgetState():
+    """Drop the GLState of the current context, to be called before the context is destroyed"""
+    state = GL_STATES.pop(contextdata.getContext(), None)
+    if _current_state[0] is state:
+        _current_state[0] = None
+
+def glState():
+    """GLState of the context that was last made current with makeStateCurrent"""
+    if _current_state[0] is None:
+        return makeStateCurrent()
+    return _current_state[0]
+
+# attribute location of a_position in all programs
+POSITION_LOCATION = 0
+
+# uniform buffer binding point of the camera matrices, see CameraBuffer
+CAMERA_BINDING = 0
+# std140 declaration of the camera uniform block, to be included in shader sources
+CAMERA_BLOCK = """layout(std140) uniform Camera {
+            mat4 u_model;
+            mat4 u_view;
+            mat4 u_projection;
+            float u_model_scale;
+        };"""
+
+def _matrixSetter(function):
+    return lambda location, count, value: function(location, count, gl.GL_FALSE, value)
+
+# glUniform*v function, numpy dtype and number of components per GLSL uniform type
+UNIFORM_SETTERS = {
+    gl.GL_FLOAT: (gl.glUniform1fv, np.float32, 1),
+    gl.GL_FLOAT_VEC2: (gl.glUniform2fv, np.float32, 2),
+    gl.GL_FLOAT_VEC3: (gl.glUniform3fv, np.float32, 3),
+    gl.GL_FLOAT_VEC4: (gl.glUniform4fv, np.float32, 4),
+    gl.GL_INT: (gl.glUniform1iv, np.int32, 1),
+    gl.GL_INT_VEC2: (gl.glUniform2iv, np.int32, 2),
+    gl.GL_INT_VEC3: (gl.glUniform3iv, np.int32, 3),
+    gl.GL_INT_VEC4: (gl.glUniform4iv, np.int32, 4),
+    gl.GL_UNSIGNED_INT: (gl.glUniform1uiv, np.uint32, 1),
+    gl.GL_BOOL: (gl.glUniform1iv, np.int32, 1),
+    gl.GL_FLOAT_MAT3: (_matrixSetter(gl.glUniformMatrix3fv), np.float32, 9),
+    gl.GL_FLOAT_MAT4: (_matrixSetter(gl.glUniformMatrix4fv), np.float32, 16),
+}
+# samplers are set to the texture unit they read from
+for sampler_type in [gl.GL_SAMPLER_1D, gl.GL_SAMPLER_2D, gl.GL_SAMPLER_3D, gl.GL_SAMPLER_CUBE, gl.GL_SAMPLER_1D_ARRAY, gl.GL_SAMPLER_2D_ARRAY]:
+    UNIFORM_SETTERS[sampler_type] = (gl.glUniform1iv, np.int32, 1)
+
+class LinkedProgram(object):
+    """A linked GL program and the uniform values it was given last, shared by the ShaderPrograms with the
+    same shader sources, see ProgramCache"""
+    def __init__(self, program):
+        self.program = program
+        # uniform name -> UNIFORM_SETTERS entry, from the active uniforms of the program
+        self.uniform_setters = {}
+        for i in range(gl.glGetProgramiv(program, gl.GL_ACTIVE_UNIFORMS)):
+            name, size, uniform_type = gl.glGetActiveUniform(program, i)
+            name = name.decode() if type(name) is bytes else name
+            # arrays are reported by their first element
+            name = name.split('[')[0]
+            if uniform_type in UNIFORM_SETTERS:
+                self.uniform_setters[name] = UNIFORM_SETTERS[uniform_type]
+        # uniform name -> value last uploaded, uploads of the same value are skipped
+        self.uniform_values = {}
+
+    def setUniformValue(self, uniform_name, uniform_location, value):
+        last_value = self.uniform_values.get(uniform_name)
+        if not last_value is None and np.array_equal(last_value, value):
+            return
+        self.uniform_values[uniform_name] = value
+        setter, dtype, components = self.uniform_setters[uniform_name]
+        glState().useProgram(self.program)
+        setter(uniform_location, value.size // components, value)
+
+def userCacheDirectory():
+    """Directory for pyvi's caches in the cache directory of the user"""
+    if sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    elif os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'pyvi')
+
+class ProgramCache(object):
+    """Linked programs by context and shader sources. ShaderPrograms with the same options share one program,
+    and a program stays here when its ShaderPrograms are rebuilt with other options, so switching back does not
+    compile again. The number of variants of the shaders is small, so programs are kept until clear().
+
+    With setBinaryPath, linked programs are also stored on disk with glGetProgramBinary, so later sessions can
+    restore them with glProgramBinary instead of compiling."""
+    def __init__(self):
+        self.programs = {}
+        # programs compiled and linked, the rest of the initialisations were served from the cache
+        self.compiled = 0
+        # programs restored from binaries on disk
+        self.restored = 0
+        self.binary_path = None
+        # context -> whether it can store and restore program binaries
+        self.binary_support = {}
+
+    def setBinaryPath(self, path=True):
+        """Store program binaries in directory path, in the user cache directory if path is True, or not at all
+        if path is None"""
+        if path is True:
+            path = os.path.join(userCacheDirectory(), 'programs')
+        self.binary_path = path
+
+    def binariesSupported(self):
+        """Whether binaries are stored for the current context: a binary path is set and the driver supports
+        program binaries (GL_ARB_get_program_binary with at least one binary format), checked once per context"""
+        if self.binary_path is None:
+            return False
+        context = contextdata.getContext()
+        if not context in self.binary_support:
+            try:
+                supported = bool(gl.glProgramBinary) and bool(gl.glGetProgramBinary) and \
+                    gl.glGetIntegerv(gl.GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+            except (error.GLError, error.NullFunctionError):
+                supported = False
+            if not supported:
+                warnings.warn('program binaries are not supported by the driver, shaders are compiled', RuntimeWarning)
+            self.binary_support[context] = supported
+        return self.binary_support[context]
+
+    def binaryFile(self, vertex_source, fragment_source):
+        # binaries only work for the driver that made them
+        renderer = gl.glGetString(gl.GL_RENDERER) or b''
+        version = gl.glGetString(gl.GL_VERSION) or b''
+        digest = hashlib.sha1()
+        for part in [vertex_source[1], fragment_source[1]]:
+            digest.update(part.encode())
+        for part in [renderer, version]:
+            digest.update(part)
+        return os.path.join(self.binary_path, digest.hexdigest() + '.bin')
+
+    def loadBinary(self, vertex_source, fragment_source):
+        """A program restored from a stored binary of the sources, or None if there is none that works"""
+        if not self.binariesSupported():
+            return None
+        path = self.binaryFile(vertex_source, fragment_source)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if len(data) <= 4:
+            return None
+        binary_format = np.frombuffer(data[:4], dtype=np.uint32)[0]
+        binary = np.frombuffer(data[4:], dtype=np.uint8)
+        program = gl.glCreateProgram()
+        try:
+            gl.glProgramBinary(program, binary_format, binary, len(binary))
+            linked = gl.glGetProgramiv(program, gl.GL_LINK_STATUS)
+        except (error.GLError, error.NullFunctionError):
+            # drivers may reject a binary format they no longer support with GL_INVALID_ENUM
+            linked = False
+        if not linked:
+            # eg after a driver update that kept the version string, compile again
+            gl.glDeleteProgram(program)
+            return None
+        self.restored += 1
+        return program
+
+    def saveBinary(self, vertex_source, fragment_source, program):
+        if not self.binariesSupported() or not gl.glGetProgramiv(program, gl.GL_LINK_STATUS):
+            return
+        length = gl.glGetProgramiv(program, gl.GL_PROGRAM_BINARY_LENGTH)
+        if not length:
+            return
+        binary = np.empty(length, dtype=np.uint8)
+        written = np.zeros(1, dtype=np.int32)
+        binary_format = np.zeros(1, dtype=np.uint32)
+        gl.glGetProgramBinary(program, length, written, binary_format, binary)
+        path = self.binaryFile(vertex_source, fragment_source)
+        try:
+            if not os.path.exists(self.binary_path):
+                os.makedirs(self.binary_path)
+            # written in one go, so a concurrent session never reads half a binary
+            with open(path + '.tmp', 'wb') as f:
+                f.write(binary_format.tobytes())
+                f.write(binary[:written[0]].tobytes())
+            os.replace(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            warnings.warn('could not store program binary: {}'.format(e), RuntimeWarning)
+
+    def get(self, key):
+        return self.programs.get(key)
+
+    def add(self, key, linked):
+        self.programs[key] = linked
+
+    def discard(self, linked):
+        """Delete the program of linked (as returned by get) and drop it from the cache"""
+        for key in [key for key, value in self.programs.items() if value is linked]:
+            del self.programs[key]
+        glState().deleteProgram(linked.program)
+
+    def clear(self):
+        """Delete the programs of the current context"""
+        context = contextdata.getContext()
+        for key in [key for key in self.programs if key[0] == context]:
+            glState().deleteProgram(self.programs.pop(key).program)
+        self.binary_support.pop(context, None)
+
+PROGRAM_CACHE = ProgramCache()
+
 class ShaderProgram(object):
     def __init__(self):
         self.uniform_names = []
+        # uniform block name -> binding point
+        self.uniform_blocks = {}
         self.attribute_names = []
         # self.shader_sources = []
         self.uniforms = {}
+        # uniform name -> UNIFORM_SETTERS entry, from the active uniforms of the linked program
+        self.uniform_setters = {}
+        # uniform name -> value set on this ShaderProgram, uploaded again on bind() as the linked program may be shared
+        self.uniform_values = {}
+        self.linked = None
         self.shaders = []
         self.is_bound = False
         self.is_initialised = False
@@ -42,6 +540,10 @@ class ShaderProgram(object):
 
         for shader in self.shaders:
             gl.glAttachShader(self.program, shader)
+        # the same location in every program, so a VAO can be drawn with another program (eg for picking)
+        gl.glBindAttribLocation(self.program, POSITION_LOCATION, 'a_position')
+        if PROGRAM_CACHE.binariesSupported():
+            gl.glProgramParameteri(self.program, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, gl.GL_TRUE)
         gl.glLinkProgram(self.program)
 
         if not gl.glGetProgramiv(self.program, gl.GL_LINK_STATUS):
@@ -51,11 +553,37 @@ class ShaderProgram(object):
             gl.glDetachShader(self.program, shader)
         self.shaders = []
 
+    def programKey(self):
+        return contextdata.getContext(), self.vertexShaderSource, self.fragmentShaderSource, tuple(sorted(self.uniform_blocks.items()))
+
     def initialise(self):
-        self.compileShaders()
-        self.link()
+        key = self.programKey()
+        self.linked = PROGRAM_CACHE.get(key)
+        if self.linked is None:
+            vertex_source, fragment_source = self.vertexShaderSource, self.fragmentShaderSource
+            program = PROGRAM_CACHE.loadBinary(vertex_source, fragment_source)
+            if program is None:
+                self.compileShaders()
+                self.link()
+                PROGRAM_CACHE.compiled += 1
+                PROGRAM_CACHE.saveBinary(vertex_source, fragment_source, self.program)
+            else:
+                self.program = program
+            # uniform block bindings are not part of program binaries
+            for name, binding in self.uniform_blocks.items():
+                index = gl.glGetUniformBlockIndex(self.program, name)
+                if index == gl.GL_INVALID_INDEX: raise NameError("Invalid uniform block name '{}'".format(name))
+                gl.glUniformBlockBinding(self.program, index, binding)
+            self.linked = LinkedProgram(self.program)
+            PROGRAM_CACHE.add(key, self.linked)
+        self.program = self.linked.program
+        self.uniform_setters = self.linked.uniform_setters
+        self.uniform_values = {}
+        self.uniforms = {}
         for name in self.uniform_names:
             self.uniforms[name] = self.uniformLocation(name)
+        # attribute locations may have changed, so VAOs need to be set up again
+        self.version += 1
         self.is_initialised = True
 
     def attributeLocation(self, attribute_name):
@@ -70,32 +598,32 @@ class ShaderProgram(object):
 
     def setUniformValue(self, uniform_name, value):
         uniform_location = self.uniforms[uniform_name]
-        if not self.is_bound:
-            gl.glUseProgram(self.program)
-        if type(value) in [float, np.float64, np.float32]:
-            gl.glUniform1f(uniform_location, np.float32(value))
-        elif type(value) == np.ndarray and value.shape == (4,4):
-            gl.glUniformMatrix4fv(uniform_location, 1, gl.GL_FALSE, np.float32(value))
-        elif type(value) == np.ndarray and value.shape == (4,):
-            gl.glUniform4f(uniform_location, np.float32(value[0]), np.float32(value[1]), np.float32(value[2]), np.float32(value[3]))
-        else:
-            import ipdb; ipdb.set_trace()
-            raise NotImplementedError
-        if not self.is_bound:
-            gl.glUseProgram(0)
+        if not uniform_name in self.uniform_setters:
+            raise TypeError("Unsupported type of uniform '{}'".format(uniform_name))
+        setter, dtype, components = self.uniform_setters[uniform_name]
+        value = np.array(value, dtype=dtype)
+        if value.size == 0 or value.size % components:
+            raise TypeError("Uniform '{}' needs a multiple of {} values, got {}".format(uniform_name, components, value.size))
+        self.uniform_values[uniform_name] = value
+        self.linked.setUniformValue(uniform_name, uniform_location, value)
 
     def bind(self):
-        gl.glUseProgram(self.program)
+        glState().useProgram(self.program)
+        # other ShaderPrograms that share the linked program may have set other values
+        for name, value in self.uniform_values.items():
+            self.linked.setUniformValue(name, self.uniforms[name], value)
         self.is_bound = True
 
     def release(self):
-        gl.glUseProgram(0)
+        # the program stays in use until another one is bound
         self.is_bound = False
 
     def delete(self):
-        if self.is_initialised:
-            gl.glDeleteProgram(self.program)
+        # the linked program stays in PROGRAM_CACHE, for other ShaderPrograms and for switching back to these options
+        self.linked = None
         self.uniforms = {}
+        self.uniform_setters = {}
+        self.uniform_values = {}
         self.is_bound = False
         self.is_initialised = False
 
@@ -104,6 +632,59 @@ class ShaderProgram(object):
 #         super(DataShaderProgram, self).__init__()
 #         self.uniform_names = 
 
+class CameraBuffer(object):
+    """Uniform buffer with the camera matrices of a view. It is written once per frame and bound to
+    CAMERA_BINDING, so programs that include CAMERA_BLOCK need no per draw matrix uploads"""
+    # std140 layout of CAMERA_BLOCK
+    dtype = np.dtype({
+        'names': ['u_model', 'u_view', 'u_projection', 'u_model_scale'],
+        'formats': [(np.float32, (4,4)), (np.float32, (4,4)), (np.float32, (4,4)), np.float32],
+        'offsets': [0, 64, 128, 192],
+        'itemsize': 208
+    })
+
+    def __init__(self):
+        self.data = np.zeros(1, dtype=self.dtype)
+        # model-view matrix and view frustum planes (see frustumPlanes) of the matrices, for culling
+        self.modelview = None
+        self.frustum_planes = None
+        self.is_initialised = False
+        # data differs from what was last uploaded
+        self.is_changed = True
+
+    def initialise(self):
+        self.uniform_buffer = gl.glGenBuffers(1)
+        glState().bindBuffer(gl.GL_UNIFORM_BUFFER, self.uniform_buffer)
+        gl.glBufferData(gl.GL_UNIFORM_BUFFER, self.dtype.itemsize, None, gl.GL_DYNAMIC_DRAW)
+        self.is_changed = True
+        self.is_initialised = True
+
+    def setMatrices(self, model, view, projection, model_scale):
+        values = (model, view, projection, model_scale)
+        changed = self.frustum_planes is None
+        for name, value in zip(self.dtype.names, values):
+            if not np.array_equal(self.data[name][0], value):
+                self.data[name][0] = value
+                self.is_changed = changed = True
+        if changed:
+            self.modelview = np.dot(model, view)
+            self.frustum_planes = frustumPlanes(np.dot(self.modelview, projection))
+
+    def bind(self):
+        """Upload the matrices if they changed and bind the buffer to CAMERA_BINDING"""
+        if not self.is_initialised:
+            self.initialise()
+        if self.is_changed:
+            glState().bindBuffer(gl.GL_UNIFORM_BUFFER, self.uniform_buffer)
+            gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, 0, self.dtype.itemsize, self.data)
+            self.is_changed = False
+        glState().bindBufferBase(gl.GL_UNIFORM_BUFFER, CAMERA_BINDING, self.uniform_buffer)
+
+    def delete(self):
+        if self.is_initialised:
+            glState().deleteBuffer(self.uniform_buffer)
+            self.is_initialised = False
+
 class ColorMap(object):
     def __init__(self):
         self.image = None
@@ -114,8 +695,7 @@ class ColorMap(object):
         
 
     def bind(self):
-        gl.glActiveTexture(gl.GL_TEXTURE0)
-        gl.glBindTexture(gl.GL_TEXTURE_1D, self.texture)
+        glState().bindTexture(gl.GL_TEXTURE_1D, self.texture)
 
     def initialise(self):
         self.texture = gl.glGenTextures(1)
@@ -163,81 +743,603 @@ class ColorMap(object):
         self.bind()
         gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
         gl.glTexImage1D(gl.GL_TEXTURE_1D, 0, gl.GL_RGB, self.width, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, self.image)
-        gl.glBindTexture(gl.GL_TEXTURE_1D, 0)
 
     def update(self):
         self.bind()
         gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
         gl.glTexSubImage1D(gl.GL_TEXTURE_1D, 0, 0, self.width, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, self.image)
-        gl.glBindTexture(gl.GL_TEXTURE_1D, 0)
 
     def delete(self):
         if self.is_initialised:
-            gl.glDeleteTextures(1, gl.GLuint(self.texture))
+            glState().deleteTexture(self.texture)
+
+class FrameBuffer(object):
+    """Framebuffer object with a color and a depth renderbuffer, for rendering offscreen"""
+    def __init__(self, width, height, internal_format=gl.GL_RGBA8):
+        self.width = width
+        self.height = height
+        self.internal_format = internal_format
+        self.is_initialised = False
+
+    def initialise(self):
+        self.framebuffer = gl.glGenFramebuffers(1)
+        self.color_buffer, self.depth_buffer = gl.glGenRenderbuffers(2)
+        self.allocate()
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.framebuffer)
+        gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_RENDERBUFFER, self.color_buffer)
+        gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, gl.GL_RENDERBUFFER, self.depth_buffer)
+        if gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER) != gl.GL_FRAMEBUFFER_COMPLETE:
+            raise Exception('Framebuffer is incomplete')
+        self.is_initialised = True
+
+    def allocate(self):
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.color_buffer)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, self.internal_format, self.width, self.height)
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.depth_buffer)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, gl.GL_DEPTH_COMPONENT24, self.width, self.height)
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, 0)
+
+    def resize(self, width, height):
+        if (width, height) != (self.width, self.height):
+            self.width, self.height = width, height
+            if self.is_initialised:
+                self.allocate()
+
+    def bind(self):
+        if not self.is_initialised:
+            self.initialise()
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.framebuffer)
+
+    def release(self, framebuffer=0):
+        """Bind framebuffer again, for a QWindow this is the default framebuffer object of its context"""
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, framebuffer)
+
+    def delete(self):
+        if self.is_initialised:
+            gl.glDeleteFramebuffers(1, gl.GLuint(self.framebuffer))
+            gl.glDeleteRenderbuffers(2, np.array([self.color_buffer, self.depth_buffer], dtype=np.uint32))
+            self.is_initialised = False
+
+class PixelReader(object):
+    """Reads pixels of the bound framebuffer into a pixel pack buffer, so the transfer does not stall the
+    render loop. The pixels are fetched with poll() once the GPU is done with them."""
+    def __init__(self):
+        self.pack_buffer = None
+        self.capacity = 0
+        self.fence = None
+        self.shape = None
+        self.dtype = None
+
+    @property
+    def is_pending(self):
+        return not self.fence is None
+
+    def read(self, x, y, width, height, format, type, dtype, components):
+        """Start reading a width x height block of pixels at x, y (from the bottom left), each pixel has
+        components values of numpy type dtype"""
+        nbytes = width * height * components * np.dtype(dtype).itemsize
+        state = glState()
+        if self.pack_buffer is None:
+            self.pack_buffer = gl.glGenBuffers(1)
+        state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+        if nbytes > self.capacity:
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, nbytes, None, gl.GL_STREAM_READ)
+            self.capacity = nbytes
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadPixels(x, y, width, height, format, type, ctypes.c_void_p(0))
+        # a bound pack buffer would also catch reads into client memory
+        state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        if not self.fence is None:
+            gl.glDeleteSync(self.fence)
+        self.fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.shape = (height, width, components)
+        self.dtype = np.dtype(dtype)
+
+    def poll(self, wait=False):
+        """The pixels of the last read as a height x width x components array with the bottom row first,
+        or None if they are not available (yet)"""
+        if self.fence is None:
+            return None
+        timeout = FENCE_TIMEOUT if wait else 0
+        while True:
+            status = gl.glClientWaitSync(self.fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+            if status != gl.GL_TIMEOUT_EXPIRED or not wait:
+                break
+        if status == gl.GL_TIMEOUT_EXPIRED:
+            return None
+        gl.glDeleteSync(self.fence)
+        self.fence = None
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        state = glState()
+        state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+        ptr = ctypes.cast(gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, nbytes, gl.GL_MAP_READ_BIT), ctypes.c_void_p).value
+        pixels = np.frombuffer((ctypes.c_ubyte*nbytes).from_address(ptr), dtype=self.dtype).reshape(self.shape).copy()
+        gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+        state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        return pixels
+
+    def delete(self):
+        if not self.fence is None:
+            gl.glDeleteSync(self.fence)
+            self.fence = None
+        if not self.pack_buffer is None:
+            glState().deleteBuffer(self.pack_buffer)
+            self.pack_buffer = None
+            self.capacity = 0
+
+# storage grows by this factor when it runs out of capacity, and is shrunk once
+# less than SHRINK_RATIO of it was used for SHRINK_DELAY consecutive uploads
+GROWTH = 1.5
+SHRINK_RATIO = 0.25
+SHRINK_DELAY = 8
+
+# gaps between dirty row ranges smaller than this many bytes are uploaded along
+# with the ranges, one large glBufferSubData is cheaper than many small ones
+DIRTY_MERGE_BYTES = 4096
+
+def _merge_ranges(ranges, gap=0):
+    """Sort and merge [start, end) ranges that overlap or are less than gap apart"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+def _index_ranges(idx, gap=0):
+    """Convert an array of row indices into a list of [start, end) ranges"""
+    idx = np.unique(idx)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > gap + 1)
+    starts = np.concatenate([idx[:1], idx[breaks+1]])
+    ends = np.concatenate([idx[breaks], idx[-1:]]) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+class BufferPool(object):
+    """Process-wide pool of GL buffer objects released by deleted Buffers, kept per GL context"""
+    def __init__(self, max_bytes=512*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.free = {} # context -> [(capacity, vertex_buffer), ...], oldest first
+
+    def acquire(self, nbytes):
+        """Return (vertex_buffer, capacity) of a pooled buffer that fits nbytes without wasting too much, or (None, 0)"""
+        context = contextdata.getContext()
+        self.trim(context)
+        free = self.free.get(context, [])
+        best = None
+        for i, (capacity, vertex_buffer) in enumerate(free):
+            if nbytes <= capacity <= max(2*nbytes, 65536):
+                if best is None or capacity < free[best][0]:
+                    best = i
+        if best is None:
+            return None, 0
+        capacity, vertex_buffer = free.pop(best)
+        self.nbytes -= capacity
+        return vertex_buffer, capacity
+
+    def release(self, context, vertex_buffer, capacity):
+        self.free.setdefault(context, []).append((capacity, vertex_buffer))
+        self.nbytes += capacity
+        # buffers can only be deleted in their own context, which may not be current when a node is closed,
+        # otherwise the next trim() from the render loop frees them
+        if context == currentContext():
+            self.trim(context)
+
+    def trim(self, context=None):
+        """Delete the oldest pooled buffers of context (the current one if None) until the pool fits max_bytes"""
+        if context is None:
+            context = contextdata.getContext()
+        free = self.free.get(context, [])
+        while self.nbytes > self.max_bytes and free:
+            capacity, vertex_buffer = free.pop(0)
+            glState().deleteBuffer(vertex_buffer)
+            self.nbytes -= capacity
+
+    def clear(self):
+        """Delete the pooled buffers of the current context"""
+        for capacity, vertex_buffer in self.free.pop(contextdata.getContext(), []):
+            glState().deleteBuffer(vertex_buffer)
+            self.nbytes -= capacity
+
+BUFFER_POOL = BufferPool()
 
 class Buffer(object):
+    # return the GL storage to BUFFER_POOL on delete
+    pooled = True
+    # binding point used to upload data
+    target = gl.GL_ARRAY_BUFFER
+
     def __init__(self, struct_array=None):
         self.data = struct_array
         self.len = None
         self.vertex_buffer = None
+        # bytes of GL storage, len(self.data) may use less
+        self.capacity = 0
+        self.underused = 0
+        self.reserved = False
+        self.context = None
+        # [start, end) row ranges of self.data that still need to be uploaded
+        self.dirty = []
+        # row in the GL storage where self.data starts
+        self.base = 0
+        # rows from the start that hold current data and can be drawn
+        self.resident = 0
+        # UploadQueue that defers uploads to the render loop, immediate uploads if None
+        self.queue = None
 
         self.is_initialised = False
+        # bumped when the vertex layout changes
         self.version = 0
+        # bumped whenever the contents of self.data change
+        self.revision = 0
 
     def initialise(self):
         if self.data is None:
             raise Exception("Can't initialise buffer without data'")
-        self.vertex_buffer = gl.glGenBuffers(1)
-        if gl.glGetError()==gl.GL_INVALID_ENUM:
-            raise Exception('Failed to create buffer')
+        self.context = contextdata.getContext()
+        if self.pooled:
+            self.vertex_buffer, self.capacity = BUFFER_POOL.acquire(self.data.nbytes)
+        if self.vertex_buffer is None:
+            self.vertex_buffer = gl.glGenBuffers(1)
+            if gl.glGetError()==gl.GL_INVALID_ENUM:
+                raise Exception('Failed to create buffer')
         self.create()
         self.is_initialised = True
 
-    def setAttribute(self, key, value):
-        self.data[key] = value
-        self.update()
+    def setAttribute(self, key, value, idx=None):
+        """Set field key for the rows selected by idx (a slice, index array or mask, all rows if None) and upload only those rows"""
+        if idx is None:
+            self.data[key] = value
+            self.markDirty()
+        elif type(idx) is slice:
+            self.data[key][idx] = value
+            rows = range(*idx.indices(len(self.data)))
+            if len(rows):
+                self.markDirty(min(rows[0], rows[-1]), max(rows[0], rows[-1])+1)
+        else:
+            idx = np.asarray(idx)
+            if idx.dtype == bool:
+                idx = np.flatnonzero(idx)
+            self.data[key][idx] = value
+            self.dirty += _index_ranges(idx, self.mergeGap())
+        self.revision += 1
+        if self.is_initialised:
+            self.update()
+
+    def markDirty(self, start=0, end=None):
+        """Flag rows [start, end) of self.data for upload on the next update()"""
+        if end is None:
+            end = len(self.data)
+        if end > start:
+            self.dirty.append((start, end))
+
+    def mergeGap(self):
+        return max(0, DIRTY_MERGE_BYTES // self.data.dtype.itemsize)
 
     def setData(self, struct_array):
+        layout_changed = self.data is None or self.data.dtype != struct_array.dtype
         self.data = struct_array
+        self.revision += 1
         if self.is_initialised:
             self.create()
-            self.version += 1
+            # the VAO stays valid as long as the buffer object and the vertex layout are the same
+            if layout_changed:
+                self.version += 1
 
     def create(self):
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
-        gl.glBufferData(gl.GL_ARRAY_BUFFER, self.data.nbytes, self.data, gl.GL_DYNAMIC_DRAW)        
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        self.data = np.ascontiguousarray(self.data)
+        # storage is sized on the first upload, which may be deferred to the render loop
+        self.reserved = False
+        # any pending partial updates are superseded
+        self.dirty = []
+        self.resident = 0
         self.len = len(self.data)
         self.setDrawRange(0, self.len)
+        self.markDirty()
+        self.update()
+
+    def reserve(self, nbytes):
+        """Make sure the GL storage fits nbytes, growing geometrically and shrinking lazily"""
+        if nbytes > self.capacity:
+            capacity = max(nbytes, int(self.capacity*GROWTH))
+        elif nbytes < self.capacity*SHRINK_RATIO:
+            self.underused += 1
+            if self.underused < SHRINK_DELAY:
+                return
+            capacity = int(nbytes*GROWTH)
+        else:
+            self.underused = 0
+            return
+        self.underused = 0
+        glState().bindBuffer(self.target, self.vertex_buffer)
+        gl.glBufferData(self.target, capacity, None, gl.GL_DYNAMIC_DRAW)
+        self.capacity = capacity
 
     def update(self):
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
-        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, self.len, self.data)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        if not self.dirty:
+            return
+        if self.queue is None:
+            self.upload()
+        else:
+            self.queue.submit(self)
+
+    def upload(self, budget=None):
+        """Upload the dirty ranges, or as much of them as fits in budget bytes. Returns the number of bytes uploaded"""
+        if not self.reserved:
+            self.reserve(self.data.nbytes)
+            self.reserved = True
+        itemsize = self.data.dtype.itemsize
+        ranges = _merge_ranges(self.dirty, self.mergeGap())
+        uploaded = 0
+        glState().bindBuffer(self.target, self.vertex_buffer)
+        while ranges:
+            start, end = ranges[0]
+            if not budget is None:
+                # always make some progress
+                rows = max((budget-uploaded) // itemsize, 0 if uploaded else 1)
+                if rows == 0:
+                    break
+                end = min(end, start+rows)
+            gl.glBufferSubData(self.target, start*itemsize, (end-start)*itemsize, self.data[start:end])
+            uploaded += (end-start)*itemsize
+            if start <= self.resident < end:
+                self.resident = end
+            if end == ranges[0][1]:
+                ranges.pop(0)
+            else:
+                ranges[0] = (end, ranges[0][1])
+        self.dirty = ranges
+        return uploaded
+
+    def dirtyBytes(self):
+        return sum(end-start for start, end in _merge_ranges(self.dirty, self.mergeGap())) * self.data.dtype.itemsize
 
     def setDrawRange(self, start, end):
         self.start = start
         self.end = end
-    
+
+    def fence(self):
+        """Called after a draw call that sources from this buffer"""
+        pass
+
+    def delete(self):
+        if self.is_initialised:
+            if self.pooled:
+                BUFFER_POOL.release(self.context, self.vertex_buffer, self.capacity)
+            else:
+                glState().deleteBuffer(self.vertex_buffer)
+            self.vertex_buffer = None
+            self.capacity = 0
+            self.is_initialised = False
+
+class UploadQueue(object):
+    """Buffer uploads that are done from the render loop, at most budget bytes per frame.
+    Buffers are uploaded in the order they were submitted, and painters draw the prefix
+    of their buffers that has arrived so far."""
+    def __init__(self, budget=64*2**20):
+        self.budget = budget
+        self.buffers = []
+        # bytes uploaded since the queue was last empty, for progress reporting
+        self.done = 0
+
+    def submit(self, buffer):
+        # the buffer's dirty ranges always describe its newest data, so a buffer
+        # that is queued already needs no further work
+        if not any(queued is buffer for queued in self.buffers):
+            self.buffers.append(buffer)
+
+    def drain(self, budget=None):
+        """Upload up to budget bytes (self.budget if None), returns the number of bytes uploaded"""
+        if budget is None:
+            budget = self.budget
+        uploaded = 0
+        while self.buffers and uploaded < budget:
+            buffer = self.buffers[0]
+            if buffer.is_initialised and buffer.dirty:
+                uploaded += buffer.upload(budget-uploaded)
+            if not buffer.is_initialised or not buffer.dirty:
+                self.buffers.pop(0)
+        self.done += uploaded
+        if not self.buffers:
+            self.done = 0
+        return uploaded
+
+    def remaining(self):
+        return sum(buffer.dirtyBytes() for buffer in self.buffers if buffer.is_initialised)
+
+    def progress(self):
+        """Fraction of the queued bytes that has been uploaded"""
+        remaining = self.remaining()
+        if remaining == 0:
+            return 1.
+        return self.done / float(self.done + remaining)
+
+    def isEmpty(self):
+        return len(self.buffers) == 0
+
+class IndexBuffer(Buffer):
+    """Vertex indices for indexed drawing, stored as uint16 when the indexed vertices allow it and uint32 otherwise"""
+    # the element array binding is part of the VAO state, so uploads go through
+    # a binding point that does not touch whatever VAO is bound
+    target = gl.GL_COPY_WRITE_BUFFER
+
+    def __init__(self, indices=None, n_vertices=None):
+        super(IndexBuffer, self).__init__()
+        if not indices is None:
+            self.setIndices(indices, n_vertices)
+
+    def setIndices(self, indices, n_vertices=None):
+        indices = np.asarray(indices).ravel()
+        if n_vertices is None:
+            n_vertices = int(indices.max())+1 if len(indices) else 0
+        if n_vertices <= 2**16:
+            indices = indices.astype(np.uint16, copy=False)
+        else:
+            indices = indices.astype(np.uint32, copy=False)
+        self.setData(indices)
+
+    @property
+    def gl_type(self):
+        if self.data.dtype == np.uint16:
+            return gl.GL_UNSIGNED_SHORT
+        return gl.GL_UNSIGNED_INT
+
+class StreamBuffer(Buffer):
+    """Buffer for data that is replaced every frame.
+
+    The GL storage holds `segments` copies of the data and every upload goes
+    to the next segment, so the GPU can keep drawing from the previous ones.
+    In 'persistent' mode the storage is mapped once (GL_ARB_buffer_storage) and
+    written directly, in 'orphan' mode the storage is orphaned when wrapping
+    around and segments are written through an unsynchronised mapping. Fences
+    guard segments that may still be in use."""
+    # immutable storage can not be handed to another Buffer
+    pooled = False
+
+    def __init__(self, struct_array=None, segments=3, mode=None):
+        super(StreamBuffer, self).__init__(struct_array)
+        self.segments = segments
+        self.mode = mode # 'persistent', 'orphan' or None to pick the best available
+        self.segment = 0
+        self.segment_capacity = 0 # rows per segment
+        self.fences = [None]*segments
+        self.mapped = None
+
+    def initialise(self):
+        if self.mode is None:
+            if bool(gl.glBufferStorage) and hasExtension('GL_ARB_buffer_storage'):
+                self.mode = 'persistent'
+            else:
+                self.mode = 'orphan'
+        super(StreamBuffer, self).initialise()
+
+    def setData(self, struct_array):
+        fits = not self.data is None and self.data.dtype == struct_array.dtype and len(struct_array) <= self.segment_capacity
+        # written with a plain memory copy in orphan mode
+        self.data = np.ascontiguousarray(struct_array)
+        self.revision += 1
+        if self.is_initialised:
+            if fits:
+                self.write()
+            else:
+                self.create()
+                self.version += 1
+
+    def create(self):
+        self.data = np.ascontiguousarray(self.data)
+        self.segment_capacity = max(len(self.data), 2*self.segment_capacity, 1)
+        nbytes = self.segments * self.segment_capacity * self.data.dtype.itemsize
+        self.capacity = nbytes
+        self.deleteFences()
+        if self.mode == 'persistent':
+            # immutable storage can not be resized, start over with a new buffer
+            if not self.mapped is None:
+                self.unmap()
+                glState().deleteBuffer(self.vertex_buffer)
+                self.vertex_buffer = gl.glGenBuffers(1)
+            flags = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_PERSISTENT_BIT | gl.GL_MAP_COHERENT_BIT
+            glState().bindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
+            gl.glBufferStorage(gl.GL_ARRAY_BUFFER, nbytes, None, flags)
+            ptr = ctypes.cast(gl.glMapBufferRange(gl.GL_ARRAY_BUFFER, 0, nbytes, flags), ctypes.c_void_p).value
+            self.mapped = np.frombuffer((ctypes.c_ubyte*nbytes).from_address(ptr), dtype=self.data.dtype)
+        else:
+            glState().bindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, nbytes, None, gl.GL_STREAM_DRAW)
+        self.segment = self.segments-1
+        self.write()
+
+    def write(self):
+        """Upload self.data to the next segment and point the draw range at it"""
+        self.segment = (self.segment+1) % self.segments
+        n = len(self.data)
+        self.base = self.segment * self.segment_capacity
+        if self.mode == 'orphan' and self.segment == 0:
+            # let the driver hand out fresh storage, nothing can be in flight in it
+            self.deleteFences()
+            glState().bindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, self.capacity, None, gl.GL_STREAM_DRAW)
+        self.waitFence(self.segment)
+        if self.mode == 'persistent':
+            self.mapped[self.base:self.base+n] = self.data
+        elif n > 0:
+            itemsize = self.data.dtype.itemsize
+            access = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_RANGE_BIT | gl.GL_MAP_UNSYNCHRONIZED_BIT
+            glState().bindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
+            ptr = gl.glMapBufferRange(gl.GL_ARRAY_BUFFER, self.base*itemsize, n*itemsize, access)
+            ctypes.memmove(ptr, self.data.ctypes.data, n*itemsize)
+            gl.glUnmapBuffer(gl.GL_ARRAY_BUFFER)
+        self.dirty = []
+        self.len = n
+        self.resident = n
+        self.setDrawRange(0, n)
+
     def update(self):
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
-        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, self.data.nbytes, self.data)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        # older segments hold stale data, so partial updates go out as a full frame,
+        # which is never deferred to an UploadQueue
+        if self.dirty:
+            self.write()
+
+    def fence(self):
+        if not self.fences[self.segment] is None:
+            gl.glDeleteSync(self.fences[self.segment])
+        self.fences[self.segment] = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+    def waitFence(self, segment):
+        fence = self.fences[segment]
+        if fence is None:
+            return
+        while gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, FENCE_TIMEOUT) == gl.GL_TIMEOUT_EXPIRED:
+            pass
+        gl.glDeleteSync(fence)
+        self.fences[segment] = None
+
+    def deleteFences(self):
+        for fence in self.fences:
+            if not fence is None:
+                gl.glDeleteSync(fence)
+        self.fences = [None]*self.segments
+
+    def unmap(self):
+        glState().bindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer)
+        gl.glUnmapBuffer(gl.GL_ARRAY_BUFFER)
+        self.mapped = None
 
     def delete(self):
         if self.is_initialised:
-            gl.glDeleteBuffers(1, gl.GLuint(self.vertex_buffer))
+            self.deleteFences()
+            if not self.mapped is None:
+                self.unmap()
+        super(StreamBuffer, self).delete()
 
 
 class Painter(object):
-    def __init__(self, shader_program, draw_type, buffer, colormap=None, is_visible=False):
+    # may be drawn as part of a BatchPainter, subclasses that draw differently should set this to False
+    batchable = True
+
+    def __init__(self, shader_program, draw_type, buffer, colormap=None, is_visible=False, index_buffer=None):
         self.program = shader_program
-        self.buffer = buffer
-        self.buffer_version = None
+        # the first buffer holds a_position and determines the draw range, further
+        # buffers hold other attributes so they can be replaced independently
+        self.buffers = [buffer]
+        self.index_buffer = index_buffer
+        # program and buffer versions the VAO was set up for
+        self.vertex_array_key = None
+        # row of each buffer the attribute pointers start at, StreamBuffers move it every frame
+        self.vertex_array_bases = []
         self.draw_type = draw_type
         self.draw_polywire = False
         self.colormap = colormap
         self.is_visible = is_visible
+        # fraction of each point range that is drawn, the view lowers it while the camera moves
+        self.detail = 1.
+        # index in the source data of each vertex row, reported by pick(), rows are reported if None
+        self.vertex_ids = None
+        # vertices of the last draw, for profiling
+        self.drawn_vertices = 0
         self.is_initialised = False
 
     def initialise(self):
@@ -248,13 +1350,39 @@ class Painter(object):
 
     def delete(self):
         if self.is_initialised:
-            gl.glDeleteVertexArrays(1, gl.GLuint(self.vertex_array))
+            glState().deleteVertexArray(self.vertex_array)
 
     def toggleVisibility(self):
         self.is_visible = not self.is_visible
 
+    @property
+    def buffer(self):
+        return self.buffers[0]
+
     def setBuffer(self, buffer):
-        self.buffer = buffer
+        self.buffers = [buffer]
+
+    def setBuffers(self, buffers):
+        """Source vertex attributes from several buffers, these should all have the same length"""
+        self.buffers = list(buffers)
+
+    def setIndexBuffer(self, index_buffer):
+        """Draw with glDrawElements using index_buffer, or with glDrawArrays if it is None"""
+        self.index_buffer = index_buffer
+
+    def setUploadQueue(self, queue):
+        for buffer in self.buffers:
+            buffer.queue = queue
+        if self.index_buffer:
+            self.index_buffer.queue = queue
+
+    def vertexArrayKey(self):
+        key = [(id(self.program), self.program.version)]
+        key += [(id(buffer), buffer.version) for buffer in self.buffers]
+        if self.index_buffer:
+            # the element array binding lives in the VAO
+            key.append((id(self.index_buffer), self.index_buffer.version))
+        return key
 
     def setProgram(self, program):
         self.program = program
@@ -263,43 +1391,70 @@ class Painter(object):
         self.colormap = colormap
 
     def getBBox(self):
-        return BBox(self.buffer.data['a_position'])
+        for buffer in self.buffers:
+            if 'a_position' in buffer.data.dtype.names:
+                return BBox(buffer.data['a_position'])
 
     def setAttribPointers(self):
-        gl.glBindVertexArray(self.vertex_array)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer.vertex_buffer)
+        glState().bindVertexArray(self.vertex_array)
+        for loc in range(gl.glGetIntegerv(gl.GL_MAX_VERTEX_ATTRIBS)):
+            gl.glDisableVertexAttribArray(loc)
+
+        for buffer in self.buffers:
+            self.setBufferPointers(buffer)
+            for name in buffer.data.dtype.names:
+                if name in self.program.attribute_names:
+                    gl.glEnableVertexAttribArray(self.program.attributeLocation(name))
         
-        offset = 0
-        for i, name in enumerate(self.buffer.data.dtype.names):
-            stride = self.buffer.data[name].strides[0]
-            if self.buffer.data[name].ndim == 1:
-                size = 1
-            else:
-                size = self.buffer.data[name].shape[1]
-            # import ipdb;ipdb.set_trace()
+        if self.index_buffer:
+            gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.index_buffer.vertex_buffer)
+        else:
+            gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, 0)
+        self.vertex_array_key = self.vertexArrayKey()
+        self.vertex_array_bases = [buffer.base for buffer in self.buffers]
+
+    def setBufferPointers(self, buffer):
+        """Point the attributes of buffer at its rows from buffer.base, so vertex 0 (and index 0) is the first row
+        of the current segment of a StreamBuffer, whichever of the buffers it is"""
+        glState().bindBuffer(gl.GL_ARRAY_BUFFER, buffer.vertex_buffer)
+        stride = buffer.data.dtype.itemsize
+        for name in buffer.data.dtype.names:
             if name in self.program.attribute_names:
+                dtype, offset = buffer.data.dtype.fields[name][:2]
+                size, gl_type, normalized = attribFormat(dtype)
                 loc = self.program.attributeLocation(name)
-                gl.glVertexAttribPointer(loc, size, gl.GL_FLOAT, False, stride, ctypes.c_void_p(offset))
-                gl.glEnableVertexAttribArray(loc)
-            offset += self.buffer.data.dtype[name].itemsize
-        
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
-        gl.glBindVertexArray(0)
-        self.buffer_version = self.buffer.version
+                gl.glVertexAttribPointer(loc, size, gl_type, normalized, stride, ctypes.c_void_p(buffer.base*stride + offset))
+
+    def updateBases(self):
+        """Point the attributes of the buffers that moved to another segment at their new rows"""
+        glState().bindVertexArray(self.vertex_array)
+        for i, buffer in enumerate(self.buffers):
+            if buffer.base != self.vertex_array_bases[i]:
+                self.setBufferPointers(buffer)
+                self.vertex_array_bases[i] = buffer.base
 
     def render(self, view=None):
+        self.drawn_vertices = 0
         if self.buffer:
             if not self.is_initialised:
                 self.initialise()
             # Ensure program is properly initialised
             if not self.program.is_initialised:
                 self.program.initialise()
-            # Ensure buffer is properly initialised
-            if not self.buffer.is_initialised:
-                self.buffer.initialise()
-            # see if buffer has been reset (eg it has a different size), if so we need to reset the AttribPointers
-            if self.buffer_version!=self.buffer.version: # should prob also check for program version here, in case the program was rebuilt
+            # uploads go through the view's queue, if it has one
+            self.setUploadQueue(getattr(view, 'upload_queue', None))
+            self.detail = getattr(view, 'detail', 1.)
+            # Ensure buffers are properly initialised
+            for buffer in self.buffers:
+                if not buffer.is_initialised:
+                    buffer.initialise()
+            if self.index_buffer and not self.index_buffer.is_initialised:
+                self.index_buffer.initialise()
+            # see if a buffer has a new layout or the program was rebuilt, if so we need to reset the AttribPointers
+            if self.vertex_array_key != self.vertexArrayKey():
                 self.setAttribPointers()
+            elif self.vertex_array_bases != [buffer.base for buffer in self.buffers]:
+                self.updateBases()
 
             # Ensure colormap is properly initialised
             if self.colormap:
@@ -312,7 +1467,8 @@ class Painter(object):
             if self.colormap:
                 self.colormap.bind()
 
-            if not view is None:
+            # programs with the camera block read the matrices from the view's CameraBuffer
+            if not view is None and not 'Camera' in self.program.uniform_blocks:
                 self.program.setUniformValue('u_model', view.mat_model)
                 self.program.setUniformValue('u_view', view.mat_view)
                 self.program.setUniformValue('u_projection', view.mat_projection)
@@ -320,20 +1476,408 @@ class Painter(object):
                     self.program.setUniformValue('u_model_scale', view.v_scale)
 
             # assert(gl.glGetError() == gl.GL_NO_ERROR)
-            gl.glBindVertexArray(self.vertex_array)
+            glState().bindVertexArray(self.vertex_array)
             # assert(gl.glGetError() == gl.GL_NO_ERROR)
             if self.draw_polywire:
                 gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_LINE)
-            gl.glDrawArrays(DRAW_TYPES[self.draw_type], self.buffer.start, self.buffer.end)
+            self.draw()
+            for buffer in self.buffers:
+                buffer.fence()
             # assert(gl.glGetError() == gl.GL_NO_ERROR)
             if self.draw_polywire:
                 gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_FILL)
-            gl.glBindVertexArray(0)
             # assert(gl.glGetError() == gl.GL_NO_ERROR)
             self.program.release()
     
+    def drawRanges(self):
+        """[start, end) row ranges that are drawn, of the index buffer if there is one and of the vertex buffers otherwise"""
+        if self.index_buffer:
+            return [(self.index_buffer.start, self.index_buffer.end)]
+        return [(self.buffer.start, self.buffer.end)]
+
+    def subsampledVertices(self):
+        """Number of vertices that are drawn at full detail and subsampled when self.detail < 1"""
+        if self.draw_type != 'points' or self.buffer.data is None:
+            return 0
+        if not self.buffer.is_initialised:
+            return len(self.buffer.data)
+        return sum(end - start for start, end in self.drawRanges())
+
+    def subsample(self, ranges):
+        """Shorten the ranges to a prefix of self.detail of their length, for points that are stored in
+        random order such a prefix is a uniform sample"""
+        if self.detail >= 1. or self.draw_type != 'points':
+            return ranges
+        return [(start, start + max(1, int((end-start)*self.detail))) for start, end in ranges if end > start]
+
+    def draw(self):
+        # only draw what has been uploaded so far
+        resident = min(buffer.resident for buffer in self.buffers)
+        if self.index_buffer:
+            index_buffer = self.index_buffer
+            # indices may point anywhere, so wait until all vertices are there
+            if resident < self.buffer.len:
+                return
+            itemsize = index_buffer.data.dtype.itemsize
+            ranges = [(start, min(end, index_buffer.resident)-start) for start, end in self.subsample(self.drawRanges()) if min(end, index_buffer.resident) > start]
+            self.drawn_vertices = sum(count for start, count in ranges)
+            if len(ranges) == 1:
+                start, count = ranges[0]
+                gl.glDrawElements(DRAW_TYPES[self.draw_type], count, index_buffer.gl_type, ctypes.c_void_p((index_buffer.base+start)*itemsize))
+            elif ranges:
+                count = np.array([count for start, count in ranges], dtype=np.int32)
+                offsets = (ctypes.c_void_p*len(ranges))(*[(index_buffer.base+start)*itemsize for start, count in ranges])
+                gl.glMultiDrawElements(DRAW_TYPES[self.draw_type], count, index_buffer.gl_type, offsets, len(ranges))
+        else:
+            ranges = [(start, min(end, resident)-start) for start, end in self.subsample(self.drawRanges()) if min(end, resident) > start]
+            self.drawn_vertices = sum(count for first, count in ranges)
+            if len(ranges) == 1:
+                gl.glDrawArrays(DRAW_TYPES[self.draw_type], *ranges[0])
+            elif ranges:
+                first = np.array([first for first, count in ranges], dtype=np.int32)
+                count = np.array([count for first, count in ranges], dtype=np.int32)
+                gl.glMultiDrawArrays(DRAW_TYPES[self.draw_type], first, count, len(ranges))
+
+    def renderID(self, program):
+        """Draw what was drawn by the last render() with program, which writes IDs instead of colors"""
+        if not self.is_initialised or self.vertex_array_key is None:
+            return
+        program.bind()
+        glState().bindVertexArray(self.vertex_array)
+        self.draw()
+
+    def pick(self, vertex_id):
+        """The painter and vertex index of gl_VertexID vertex_id of the last draw"""
+        return self.pickRow(vertex_id)
+
+    def pickRow(self, row):
+        if not self.vertex_ids is None:
+            return self, int(self.vertex_ids[row])
+        return self, row
+
+    def __repr__(self):
+        return "Painter[{}] {}, {}, {}".format(id(self), self.buffers, self.program, self.colormap)
+
+# vertices per primitive of the draw types that can be split into chunks
+PRIMITIVE_SIZES = {'points':1, 'lines':2, 'triangles':3}
+
+class ChunkedPainter(Painter):
+    """Painter that sorts its primitives into spatial chunks of about chunk_size primitives, and only draws
+    the chunks whose bounding box intersects the view frustum. Points that are stored in chunk order (see
+    chunkOrder) are drawn as ranges of the vertex buffers, so they are drawn while they are uploaded. Other
+    primitives are drawn from an index buffer sorted by chunk, the vertex buffers are left as they are.
+    Painters with fewer primitives than chunk_size, with a draw type that can not be split, or with points
+    that are not in chunk order, are drawn like a plain Painter."""
+    def __init__(self, shader_program, draw_type, buffer, colormap=None, is_visible=False, index_buffer=None, chunk_size=CHUNK_SIZE):
+        super(ChunkedPainter, self).__init__(shader_program, draw_type, buffer, colormap, is_visible)
+        self.chunk_size = chunk_size
+        # indices set by the user, the index buffer that is drawn from holds them sorted by chunk
+        self.source_index_buffer = index_buffer
+        self.index_buffer = index_buffer
+        self.chunk_index_buffer = IndexBuffer()
+        # buffer and index versions the chunks were computed for
+        self.chunk_key = None
+        # BBox and [start, end) rows of the drawn buffer (the chunk index buffer or the vertex buffers) per
+        # chunk, empty if not chunked
+        self.chunk_bboxes = []
+        self.chunk_ranges = np.zeros((0,2), dtype=np.int64)
+        self.chunk_mi = self.chunk_ma = np.zeros((0,3))
+        self.chunk_visible = np.zeros(0, dtype=bool)
+
+    @property
+    def batchable(self):
+        # large painters are culled per chunk instead
+        if not self.positionBuffer() is None:
+            self.updateChunks()
+        return len(self.chunk_bboxes) == 0
+
+    def setIndexBuffer(self, index_buffer):
+        self.source_index_buffer = index_buffer
+        self.chunk_key = None
+
+    def positionBuffer(self):
+        for buffer in self.buffers:
+            if not buffer.data is None and 'a_position' in buffer.data.dtype.names:
+                return buffer
+
+    def updateChunks(self):
+        position_buffer = self.positionBuffer()
+        source = self.source_index_buffer
+        key = (id(position_buffer), position_buffer.revision)
+        if source:
+            key += (id(source), source.revision)
+        if key == self.chunk_key:
+            return
+        self.chunk_key = key
+
+        self.chunk_bboxes = []
+        self.chunk_ranges = np.zeros((0,2), dtype=np.int64)
+        self.index_buffer = source
+        positions = position_buffer.data['a_position']
+        k = PRIMITIVE_SIZES.get(self.draw_type)
+        n = len(source.data) if source else len(positions)
+        if k is None or n // k <= self.chunk_size:
+            return
+
+        bbox = BBox(positions)
+        if self.draw_type == 'points' and not source:
+            # the chunks are runs of the vertex buffers
+            cell = chunkCells(positions, bbox, self.chunk_size)
+            if np.any(cell[1:] < cell[:-1]):
+                return
+            lo = hi = positions
+            primitives = None
+        else:
+            primitives = source.data if source else np.arange(len(positions), dtype=np.uint32)
+            primitives = primitives[:len(primitives)//k*k].reshape(-1, k)
+            # sort the primitives on the grid cell of their first vertex
+            p = positions[primitives[:,0]]
+            cell = chunkCells(p, bbox, self.chunk_size)
+            order = np.argsort(cell, kind='stable')
+            primitives = primitives[order]
+            cell = cell[order]
+            # bounds of all the vertices of the primitives in each chunk
+            if k == 1:
+                lo = hi = p[order]
+            else:
+                vertices = positions[primitives]
+                lo, hi = vertices.min(axis=1), vertices.max(axis=1)
+
+        # a chunk per occupied cell, split further when it has too many primitives
+        starts = np.flatnonzero(np.diff(cell)) + 1
+        bounds = np.concatenate([[0], starts, [len(cell)]])
+        starts = np.concatenate([np.arange(start, end, self.chunk_size) for start, end in zip(bounds[:-1], bounds[1:])])
+        ends = np.append(starts[1:], len(cell))
+
+        self.chunk_mi = np.minimum.reduceat(lo, starts)
+        self.chunk_ma = np.maximum.reduceat(hi, starts)
+        self.chunk_bboxes = [BBox(np.array([mi, ma])) for mi, ma in zip(self.chunk_mi, self.chunk_ma)]
+        self.chunk_ranges = np.stack([starts, ends], axis=1) * k
+        self.chunk_visible = np.ones(len(starts), dtype=bool)
+
+        if not primitives is None:
+            self.chunk_index_buffer.setIndices(primitives, len(positions))
+            self.index_buffer = self.chunk_index_buffer
+
+    def cull(self, planes):
+        """Find the chunks that intersect the view frustum with planes, see frustumPlanes"""
+        if len(self.chunk_bboxes):
+            self.chunk_visible = boxesInFrustum(planes, self.chunk_mi, self.chunk_ma)
+
+    def render(self, view=None):
+        if not self.positionBuffer() is None:
+            self.updateChunks()
+            # the view's CameraBuffer has the frustum of this frame
+            camera = getattr(view, 'camera', None)
+            if not camera is None and not camera.frustum_planes is None:
+                self.cull(camera.frustum_planes)
+        super(ChunkedPainter, self).render(view)
+
+    def drawRanges(self):
+        if len(self.chunk_bboxes) == 0:
+            return super(ChunkedPainter, self).drawRanges()
+        ranges = self.chunk_ranges[self.chunk_visible].tolist()
+        if self.detail < 1.:
+            # each chunk is subsampled on its own
+            return ranges
+        # adjacent chunks are drawn as one range
+        return _merge_ranges(ranges)
+
+    def delete(self):
+        super(ChunkedPainter, self).delete()
+        self.chunk_index_buffer.delete()
+
+class BallPainter(Painter):
+    """Draws a ball per vertex with a BallShaderProgram, as an instanced quad of 4 vertices. The buffers hold
+    one row per ball (a_position, a_radius and a color attribute), so no tessellated geometry is stored."""
+    batchable = False
+
+    def __init__(self, shader_program, buffer, colormap=None, is_visible=False):
+        super(BallPainter, self).__init__(shader_program, 'triangle_strip', buffer, colormap, is_visible)
+
+    def setAttribPointers(self):
+        super(BallPainter, self).setAttribPointers()
+        # every attribute advances once per ball
+        for buffer in self.buffers:
+            for name in buffer.data.dtype.names:
+                if name in self.program.attribute_names:
+                    gl.glVertexAttribDivisor(self.program.attributeLocation(name), 1)
+
+    def subsampledVertices(self):
+        # a ball is subsampled as one vertex
+        if self.buffer.data is None:
+            return 0
+        if not self.buffer.is_initialised:
+            return len(self.buffer.data)
+        start, end = self.drawRanges()[0]
+        return end - start
+
+    def instanceCount(self):
+        start, end = self.drawRanges()[0]
+        resident = min(buffer.resident for buffer in self.buffers)
+        n = min(end, resident)
+        # balls are staged in random order like points, so a prefix is a uniform sample
+        if self.detail < 1. and n > 0:
+            n = max(1, int(n*self.detail))
+        return n
+
+    def draw(self):
+        # instances can not start at an offset without GL 4.2, the attribute pointers start at the first row
+        n = self.instanceCount()
+        self.drawn_vertices = 4*n
+        if n > 0:
+            gl.glDrawArraysInstanced(gl.GL_TRIANGLE_STRIP, 0, 4, n)
+
+    def renderID(self, program):
+        """Draw the ball centers as points, with their instance as vertex id"""
+        if not self.is_initialised or self.vertex_array_key is None:
+            return
+        n = self.instanceCount()
+        if n > 0:
+            program.bind()
+            program.setUniformValue('u_instanced', True)
+            glState().bindVertexArray(self.vertex_array)
+            gl.glDrawArraysInstanced(gl.GL_POINTS, 0, 1, n)
+            program.setUniformValue('u_instanced', False)
+
+class BatchPainter(Painter):
+    """Draws the painters in self.members from shared buffers that hold their concatenated vertices,
+    with one glMultiDrawArrays over the ranges of the visible members"""
+    batchable = False
+
+    def __init__(self, members):
+        first = members[0]
+        super(BatchPainter, self).__init__(first.program, first.draw_type, Buffer(), colormap=first.colormap, is_visible=True)
+        self.members = []
+        # (painter id, length) of the members in the order they are stored in self.buffers
+        self.layout = []
+        # (buffer id, revision) of the member buffers that were copied into self.buffers
+        self.revisions = []
+        # [start, end) rows of each member in self.buffers
+        self.member_ranges = []
+        self.visible = []
+        self.setMembers(members)
+
+    def setMembers(self, members):
+        first = members[0]
+        self.program = first.program
+        self.colormap = first.colormap
+        layout = [(id(painter), len(painter.buffer.data)) for painter in members]
+        revisions = [tuple((id(buffer), buffer.revision) for buffer in painter.buffers) for painter in members]
+        if layout == self.layout:
+            # same members with the same lengths, only copy the ones that changed
+            for (start, end), painter, revision, old_revision in zip(self.member_ranges, members, revisions, self.revisions):
+                if revision != old_revision:
+                    for buffer, member_buffer in zip(self.buffers, painter.buffers):
+                        buffer.data[start:end] = member_buffer.data
+                        buffer.markDirty(start, end)
+                        buffer.revision += 1
+                        if buffer.is_initialised:
+                            buffer.update()
+        else:
+            if len(self.buffers) != len(first.buffers):
+                self.setBuffers([Buffer() for buffer in first.buffers])
+            for i, buffer in enumerate(self.buffers):
+                buffer.setData(np.concatenate([painter.buffers[i].data for painter in members]))
+            ends = np.cumsum([len(painter.buffer.data) for painter in members]).tolist()
+            self.member_ranges = list(zip([0]+ends[:-1], ends))
+        self.members = list(members)
+        self.layout = layout
+        self.revisions = revisions
+
+    def setVisible(self, visible):
+        """Set for each member if it should be drawn"""
+        self.visible = list(visible)
+        self.is_visible = any(self.visible)
+
+    def drawRanges(self):
+        return [r for r, visible in zip(self.member_ranges, self.visible) if visible]
+
+    def pickRow(self, row):
+        for (start, end), painter in zip(self.member_ranges, self.members):
+            if start <= row < end:
+                return painter.pickRow(row - start)
+
+    def delete(self):
+        super(BatchPainter, self).delete()
+        for buffer in self.buffers:
+            buffer.delete()
+
     def __repr__(self):
-        return "Painter[{}] {}, {}, {}".format(id(self), self.buffer, self.program, self.colormap)
+        return "BatchPainter[{}] {} members, {}".format(id(self), len(self.members), self.program)
+
+class PainterBatcher(object):
+    """Groups painters that share a program configuration, draw type and vertex layout into BatchPainters,
+    so that these are drawn with a single draw call instead of one per painter"""
+    def __init__(self, min_size=2):
+        # groups with fewer members are drawn by their own painters
+        self.min_size = min_size
+        self.batches = {}
+
+    def batchKey(self, painter):
+        """Key of the group painter can be batched into, or None if it can not be batched"""
+        if not painter.batchable or painter.index_buffer or painter.draw_polywire:
+            return None
+        buffers = painter.buffers
+        if any(buffer.data is None or isinstance(buffer, StreamBuffer) for buffer in buffers):
+            return None
+        if any(len(buffer.data) != len(buffers[0].data) for buffer in buffers):
+            return None
+        program = painter.program
+        if hasattr(program, 'options'):
+            # the options determine both the shader variant and its uniform values
+            program_key = (type(program), program.s_defines, repr(sorted(program.options.items())))
+        else:
+            program_key = id(program)
+        # the colormap is only used by programs that sample it
+        colormap_key = id(painter.colormap) if 'a_intensity' in program.attribute_names else None
+        return (program_key, colormap_key, painter.draw_type, tuple(buffer.data.dtype for buffer in buffers))
+
+    def painters(self, layers):
+        """Return the painters to render for layers, with batchable painters replaced by their BatchPainter"""
+        order = []
+        groups = {}
+        for layer in layers:
+            for painter in layer.painters:
+                visible = layer.is_visible and painter.is_visible
+                key = self.batchKey(painter)
+                if key is None:
+                    if visible:
+                        order.append(painter)
+                    continue
+                if not key in groups:
+                    groups[key] = []
+                    order.append(key)
+                groups[key].append((painter, visible))
+
+        for key in list(self.batches):
+            if not key in groups or len(groups[key]) < self.min_size:
+                self.batches.pop(key).delete()
+
+        painters = []
+        for item in order:
+            if isinstance(item, Painter):
+                painters.append(item)
+                continue
+            members = [painter for painter, visible in groups[item]]
+            visible = [visible for painter, visible in groups[item]]
+            if len(members) < self.min_size:
+                painters += [painter for painter, v in zip(members, visible) if v]
+                continue
+            if item in self.batches:
+                self.batches[item].setMembers(members)
+            else:
+                self.batches[item] = BatchPainter(members)
+            batch = self.batches[item]
+            batch.setVisible(visible)
+            if batch.is_visible:
+                painters.append(batch)
+        return painters
+
+    def delete(self):
+        for batch in self.batches.values():
+            batch.delete()
+        self.batches = {}
 
 class Layer(object):
     def __init__(self):
@@ -341,11 +1885,11 @@ class Layer(object):
         self.painters = []
 
     def setPainter(self, painter):
-        if type(painter) is Painter:
+        if isinstance(painter, Painter):
             if not painter in self.painters:
                 self.painters.append(painter)
 
     def unsetPainter(self, painter):
-        if type(painter) is Painter:
+        if isinstance(painter, Painter):
             if painter in self.painters:
                 self.painters.remove(painter)
\ No newline at end of file
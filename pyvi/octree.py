@@ -0,0 +1,279 @@
+import os
+import heapq
+from collections import deque, OrderedDict
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .gloo import *
+from .gloo import _merge_ranges
+from .util import BBox, frustumPlanes, boxesInFrustum
+
+# node table of an octree directory, stored as nodes.npy next to points.npy
+NODE_DTYPE = np.dtype([
+    ('offset', np.int64), # first row of the node in points.npy
+    ('count', np.int64),
+    ('mi', np.float32, 3), # cube of the node
+    ('ma', np.float32, 3),
+    ('spacing', np.float32), # typical distance between the points of the node and its ancestors
+    ('level', np.int32),
+    ('children', np.int32, 8) # node index per octant, -1 if empty
+])
+
+def npyDtype(dtype, packed_normals=False):
+    """dtype of the points without field metadata, which npy files do not store, or with a_normal as
+    PACKED_NORMAL again if packed_normals"""
+    formats = []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        if packed_normals and name == 'a_normal' and field == np.dtype(np.uint32):
+            formats.append(PACKED_NORMAL)
+        else:
+            formats.append(np.dtype((field.base.str, field.shape)))
+    offsets = [dtype.fields[name][1] for name in dtype.names]
+    return np.dtype({'names': list(dtype.names), 'formats': formats, 'offsets': offsets, 'itemsize': dtype.itemsize})
+
+def buildOctree(attributes, path, node_size=2**16, seed=0, vertex_format='float'):
+    """Write the vertex attributes (a dict of name -> array with at least 'a_position', the arrays may be
+    memory-mapped) as an octree to directory path. Each node stores a random subset of at most node_size of the
+    points in its cube that are not stored in one of its ancestors, so a node drawn together with its ancestors
+    is a uniform sample of its cube. The attributes are stored in vertex_format (see VERTEX_FORMATS), converted
+    node by node. The point indices are kept in memory during the build, 4 bytes per point."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    positions = attributes['a_position']
+    n = len(positions)
+    # the nodes are uploaded as they are stored, so in a format the painters can draw
+    dtype = vertexDtype(list(attributes), vertex_format)
+    points = open_memmap(os.path.join(path, 'points.npy'), mode='w+', dtype=npyDtype(dtype), shape=(n,))
+
+    bbox = BBox(positions)
+    edge = max(float(bbox.width.max()), 1e-12)
+    index_type = np.uint32 if n < 2**32 else np.int64
+    order = np.random.RandomState(seed).permutation(n).astype(index_type)
+
+    nodes = []
+    children = []
+    offset = 0
+    # breadth first, so the coarse levels are stored together at the start of points.npy
+    queue = deque([(order, bbox.mi.astype(np.float64), edge, 0, -1, -1)])
+    while queue:
+        idx, corner, edge, level, parent, octant = queue.popleft()
+        own, rest = idx[:node_size], idx[node_size:]
+        i = len(nodes)
+        # read in index order, but store in random order so any prefix of a node is a uniform sample of it
+        shuffle = np.argsort(own)
+        inverse = np.empty_like(shuffle)
+        inverse[shuffle] = np.arange(len(own))
+        own = own[shuffle]
+        for name in dtype.names:
+            points[name][offset:offset+len(own)] = convertAttribute(attributes[name][own][inverse], dtype[name])
+        nodes.append((offset, len(own), corner, corner+edge, edge/np.sqrt(len(own)), level))
+        children.append([-1]*8)
+        if parent >= 0:
+            children[parent][octant] = i
+        offset += len(own)
+
+        if len(rest):
+            half = edge/2
+            octants = np.dot(positions[rest] >= corner+half, [1,2,4])
+            for o in range(8):
+                # keeps the random order, so the next node_size points are again a random sample
+                child = rest[octants == o]
+                if len(child):
+                    child_corner = corner + half*np.array([o & 1, (o >> 1) & 1, (o >> 2) & 1])
+                    queue.append((child, child_corner, half, level+1, i, o))
+    points.flush()
+
+    table = np.zeros(len(nodes), dtype=NODE_DTYPE)
+    for i, (offset, count, mi, ma, spacing, level) in enumerate(nodes):
+        table[i] = (offset, count, mi, ma, spacing, level, children[i])
+    np.save(os.path.join(path, 'nodes.npy'), table)
+    return Octree(path)
+
+class Octree(object):
+    """Octree written by buildOctree, the points are memory-mapped and only read when a node is loaded"""
+    def __init__(self, path):
+        self.path = path
+        self.nodes = np.load(os.path.join(path, 'nodes.npy'))
+        points = np.load(os.path.join(path, 'points.npy'), mmap_mode='r')
+        # a uint32 a_normal is a packed normal of the compact format
+        self.points = points.view(npyDtype(points.dtype, packed_normals=True))
+        self.node_size = int(self.nodes['count'].max())
+        self.bbox = BBox(np.array([self.nodes['mi'][0], self.nodes['ma'][0]]))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def nodePoints(self, node):
+        offset, count = self.nodes['offset'][node], self.nodes['count'][node]
+        return self.points[offset:offset+count]
+
+    def projectedSpacing(self, modelview, projection, viewport_height):
+        """Spacing of each node in pixels, measured at the point of its cube closest to the camera"""
+        nodes = self.nodes
+        centers = np.ones((len(nodes), 4))
+        centers[:,:3] = (nodes['mi'] + nodes['ma']) / 2
+        scale = np.linalg.norm(modelview[0,:3])
+        radius = scale * np.sqrt(3)/2 * (nodes['ma'][:,0] - nodes['mi'][:,0])
+        # clip w is the distance along the view direction for perspective projections and 1 for orthographic ones
+        w = centers.dot(np.dot(modelview, projection))[:,3]
+        if projection[3,3] == 0:
+            w = w - radius
+        w = np.maximum(w, 1e-6)
+        return nodes['spacing'] * scale * abs(projection[1,1]) * viewport_height/2. / w
+
+    def selectNodes(self, modelview, projection, viewport_height, max_error=2., max_nodes=None, planes=None):
+        """Visible nodes to draw so that the projected spacing is at most max_error pixels, refining the nodes
+        with the largest error first until max_nodes are selected. planes are the frustum planes of modelview
+        and projection, computed if None."""
+        nodes = self.nodes
+        if planes is None:
+            planes = frustumPlanes(np.dot(modelview, projection))
+        visible = boxesInFrustum(planes, nodes['mi'], nodes['ma'])
+        error = self.projectedSpacing(modelview, projection, viewport_height)
+        selected = []
+        heap = [(-error[0], 0)]
+        while heap:
+            if not max_nodes is None and len(selected) >= max_nodes:
+                break
+            e, node = heapq.heappop(heap)
+            if not visible[node]:
+                continue
+            selected.append(node)
+            if -e > max_error:
+                for child in nodes['children'][node]:
+                    if child >= 0:
+                        heapq.heappush(heap, (-error[child], int(child)))
+        return selected
+
+class SlotBuffer(Buffer):
+    """GL storage for rows of dtype that is written slice by slice with write(), there is no copy of the rows
+    in memory"""
+    def __init__(self, dtype, rows):
+        # an empty array describes the vertex layout
+        super(SlotBuffer, self).__init__(np.zeros(0, dtype=dtype))
+        self.rows = rows
+
+    def create(self):
+        # storage without data, rows are only drawn once they are written
+        self.dirty = []
+        self.reserve(self.rows * self.data.dtype.itemsize)
+        self.reserved = True
+        self.len = self.resident = self.rows
+        self.setDrawRange(0, self.rows)
+
+    def write(self, row, struct_array):
+        """Upload struct_array (eg a slice of a memory-mapped array) to the rows from row"""
+        glState().bindBuffer(self.target, self.vertex_buffer)
+        gl.glBufferSubData(self.target, row*self.data.dtype.itemsize, struct_array.nbytes, np.ascontiguousarray(struct_array))
+        self.revision += 1
+
+class OctreePainter(Painter):
+    """Draws the nodes of an Octree selected by projected spacing. Nodes are streamed from the memory-mapped
+    points into a fixed number of node sized slots of one buffer, gpu_budget bytes in total, and the least
+    recently drawn slots are reused when all are taken. At most loads_per_frame nodes are read per frame,
+    the view is redrawn until all selected nodes are loaded."""
+    batchable = False
+
+    def __init__(self, shader_program, colormap=None, is_visible=False, gpu_budget=512*2**20, max_error=2., loads_per_frame=8):
+        super(OctreePainter, self).__init__(shader_program, 'points', Buffer(), colormap, is_visible)
+        self.octree = None
+        self.gpu_budget = gpu_budget
+        self.max_error = max_error
+        self.loads_per_frame = loads_per_frame
+        self.slot_size = 0
+        # node -> slot, least recently drawn first
+        self.slots = OrderedDict()
+        self.free_slots = []
+        # nodes drawn in the last frame, and the number of selected nodes that still need to be loaded
+        self.drawn = []
+        self.pending = 0
+
+    def setOctree(self, octree):
+        self.octree = octree
+        self.setGPUBudget(self.gpu_budget)
+
+    def setGPUBudget(self, gpu_budget):
+        self.gpu_budget = gpu_budget
+        if self.octree is None:
+            return
+        self.slot_size = self.octree.node_size
+        n_slots = max(1, int(gpu_budget // (self.slot_size * self.octree.points.dtype.itemsize)))
+        # a new buffer, so no GL calls are needed here
+        self.buffer.delete()
+        self.setBuffer(SlotBuffer(self.octree.points.dtype, n_slots*self.slot_size))
+        self.slots = OrderedDict()
+        self.free_slots = list(range(n_slots))[::-1]
+        self.drawn = []
+
+    def setUploadQueue(self, queue):
+        # slots are written as they are loaded, a reused slot must not be drawn with the data of another node
+        pass
+
+    def getBBox(self):
+        return self.octree.bbox
+
+    def allocateSlot(self, keep):
+        if self.free_slots:
+            return self.free_slots.pop()
+        for node in self.slots:
+            if not node in keep:
+                return self.slots.pop(node)
+
+    def loadNode(self, node, slot):
+        # straight from the memory-mapped points into the slot
+        self.buffer.write(slot * self.slot_size, self.octree.nodePoints(node))
+        self.slots[node] = slot
+
+    def updateSlots(self, view):
+        # the matrices and frustum of this frame, computed once for all painters
+        camera = view.camera
+        projection = camera.data['u_projection'][0]
+        n_slots = self.buffer.rows // self.slot_size
+        selected = self.octree.selectNodes(camera.modelview, projection, view.viewportSize()[1], self.max_error, n_slots, camera.frustum_planes)
+        keep = set(selected)
+        loads = 0
+        self.drawn = []
+        for node in selected:
+            if node in self.slots:
+                self.slots.move_to_end(node)
+            elif loads < self.loads_per_frame:
+                slot = self.allocateSlot(keep)
+                if slot is None:
+                    break
+                self.loadNode(node, slot)
+                loads += 1
+            else:
+                continue
+            self.drawn.append(node)
+        self.pending = len(selected) - len(self.drawn)
+
+    def pickRow(self, row):
+        """The painter and the row of the point in the points of the octree"""
+        slot, row = divmod(row, self.slot_size)
+        for node, node_slot in self.slots.items():
+            if node_slot == slot:
+                return self, int(self.octree.nodes['offset'][node] + row)
+
+    def drawRanges(self):
+        counts = self.octree.nodes['count']
+        ranges = [(self.slots[node]*self.slot_size, self.slots[node]*self.slot_size + counts[node]) for node in self.drawn]
+        if self.detail < 1.:
+            # each node is subsampled on its own
+            return ranges
+        return _merge_ranges(ranges)
+
+    def render(self, view=None):
+        if self.octree is None or view is None:
+            return
+        if not self.buffer.is_initialised:
+            self.buffer.initialise()
+        self.updateSlots(view)
+        super(OctreePainter, self).render(view)
+        if self.pending:
+            view.renderLater()
+
+    def delete(self):
+        super(OctreePainter, self).delete()
+        self.buffer.delete()
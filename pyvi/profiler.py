@@ -0,0 +1,106 @@
+import csv
+import time
+import weakref
+from collections import deque
+
+import numpy as np
+from OpenGL import GL as gl
+
+from .gloo import BatchPainter
+
+def painterName(painter):
+    if isinstance(painter, BatchPainter):
+        return 'batch of {} painters'.format(len(painter.members))
+    name = getattr(painter, 'name', None)
+    if callable(name):
+        return name()
+    return repr(painter)
+
+class FrameProfiler(object):
+    """GPU time (from GL_TIME_ELAPSED queries), CPU time and vertices drawn of each painter render. Query
+    results are only read once they are at least latency frames old and available, so profiling never waits
+    for the GPU. The times are smoothed over frames, see painterStats."""
+    def __init__(self, latency=3, smoothing=0.9):
+        self.latency = latency
+        self.smoothing = smoothing
+        self.frame = 0
+        self.free_queries = []
+        # frames with unread queries, oldest first: (frame, [(painter, query, cpu seconds, vertices)])
+        self.frames = deque()
+        self.records = []
+        self.started = None
+        # painter -> [gpu ms, cpu ms, vertices]
+        self.stats = weakref.WeakKeyDictionary()
+        self.log = None
+        self.log_writer = None
+
+    def setLog(self, path):
+        """Write a row per painter per frame to the csv file at path, or stop logging if path is None"""
+        if not self.log is None:
+            self.log.close()
+            self.log = self.log_writer = None
+        if not path is None:
+            self.log = open(path, 'w', newline='')
+            self.log_writer = csv.writer(self.log)
+            self.log_writer.writerow(['frame', 'painter', 'gpu_ms', 'cpu_ms', 'vertices'])
+
+    def begin(self, painter):
+        if self.free_queries:
+            query = self.free_queries.pop()
+        else:
+            query = gl.glGenQueries(1)
+        gl.glBeginQuery(gl.GL_TIME_ELAPSED, query)
+        self.started = painter, query, time.perf_counter()
+
+    def end(self, vertices=0):
+        painter, query, start = self.started
+        cpu = time.perf_counter() - start
+        gl.glEndQuery(gl.GL_TIME_ELAPSED)
+        self.records.append((painter, query, cpu, vertices))
+        self.started = None
+
+    def endFrame(self):
+        self.frames.append((self.frame, self.records))
+        self.records = []
+        self.frame += 1
+        while self.frames and self.frame - self.frames[0][0] > self.latency and self.isAvailable(self.frames[0][1]):
+            self.collect(*self.frames.popleft())
+
+    def isAvailable(self, records):
+        # queries finish in order, so the last one of a frame decides
+        if not records:
+            return True
+        return bool(gl.glGetQueryObjectiv(records[-1][1], gl.GL_QUERY_RESULT_AVAILABLE))
+
+    def collect(self, frame, records):
+        for painter, query, cpu, vertices in records:
+            gpu = int(gl.glGetQueryObjectui64v(query, gl.GL_QUERY_RESULT)) / 1e6
+            self.free_queries.append(query)
+            values = [gpu, cpu*1e3, vertices]
+            if painter in self.stats:
+                a = self.smoothing
+                values = [a*old + (1-a)*new for old, new in zip(self.stats[painter], values)]
+            self.stats[painter] = values
+            if not self.log_writer is None:
+                self.log_writer.writerow([frame, painterName(painter), '{:.4f}'.format(gpu), '{:.4f}'.format(cpu*1e3), vertices])
+
+    def painterStats(self, painter):
+        """Smoothed (gpu ms, cpu ms, vertices) of painter, or None if it was not profiled"""
+        values = self.stats.get(painter)
+        if values is None:
+            return None
+        gpu, cpu, vertices = values
+        return gpu, cpu, int(round(vertices))
+
+    def results(self):
+        """(painter, gpu ms, cpu ms, vertices) of all profiled painters, slowest on the GPU first"""
+        results = [(painter,) + self.painterStats(painter) for painter in list(self.stats.keys())]
+        return sorted(results, key=lambda result: result[1], reverse=True)
+
+    def delete(self):
+        queries = self.free_queries + [query for frame, records in self.frames for painter, query, cpu, vertices in records]
+        if queries:
+            gl.glDeleteQueries(len(queries), np.array(queries, dtype=np.uint32))
+        self.free_queries = []
+        self.frames.clear()
+        self.setLog(None)
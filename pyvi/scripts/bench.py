@@ -0,0 +1,49 @@
+import json
+
+import click
+
+from PyQt5.QtWidgets import QApplication
+
+from pyvi.bench import runBenchmarks, compareResults
+
+@click.group()
+def cli():
+    """Rendering benchmarks on synthetic datasets. Without a display, set QT_QPA_PLATFORM=offscreen (eg with
+    LIBGL_ALWAYS_SOFTWARE=1 for Mesa's llvmpipe)."""
+    pass
+
+@cli.command()
+@click.argument("output", type=click.Path())
+@click.option("--sizes", default='1e6,1e7', help="Comma separated numbers of points, eg 1e6,1e7,1e8,2e8")
+@click.option("--kinds", default='points,lines,mesh', help="Comma separated benchmarks out of points, lines and mesh")
+@click.option("--vertex-format", default='float', type=click.Choice(['float', 'compact']))
+@click.option("--frames", default=30, help="Frames rendered to measure the frame rate")
+@click.option("--size", default=(800, 800), type=(int, int), help="Width and height of the framebuffer")
+@click.option("--clip", is_flag=True, help="Only stage the points in the upper half of their bounding box")
+def run(output, sizes, kinds, vertex_format, frames, size, clip):
+    """Run the benchmarks and write the results to OUTPUT as json"""
+    app = QApplication.instance()
+    if app is None:
+        app = QApplication([])
+    sizes = [int(float(n)) for n in sizes.split(',')]
+    kinds = kinds.split(',')
+    report = runBenchmarks(sizes, kinds, vertex_format, frames, size,
+        progress=lambda kind, n: click.echo('{} {}'.format(kind, n), err=True), clip=clip)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+@cli.command()
+@click.argument("old", type=click.File())
+@click.argument("new", type=click.File())
+def compare(old, new):
+    """Print the ratios NEW/OLD of the results of two runs"""
+    for (kind, n, vertex_format, clip, options), ratios in compareResults(json.load(old), json.load(new)):
+        options = ' '.join('{}={}'.format(key, value) for key, value in options)
+        if clip:
+            vertex_format += ' clip'
+
+        ratios = ' '.join('{}={:.3f}'.format(key, value) for key, value in sorted(ratios.items()) if not value is None)
+        click.echo('{} {} {} {}: {}'.format(kind, n, vertex_format, options, ratios))
+
+if __name__ == '__main__':
+    cli()
@@ -11,6 +11,7 @@ from PyQt5.QtWidgets import QDockWidget, QAction
 from PyQt5.QtCore import Qt
 
 from pyvi.window import SimpleWindow
+from pyvi.gloo import PROGRAM_CACHE
 
 from nodelib import LIBRARY
 from nodelib.pyvi import pvWindowNode
@@ -213,7 +214,10 @@ class pyviViewerWindow(QtGui.QMainWindow):
 @click.command()
 @click.argument("dataset", type=click.Path(exists=True), default=INFILE)
 @click.option("--flowchart", required=False, type=click.Path(exists=True))
-def cli(dataset, flowchart):
+@click.option("--program-cache", is_flag=True, help="Store compiled shader programs in the user cache directory, so the next start is faster")
+def cli(dataset, flowchart, program_cache):
+    if program_cache:
+        PROGRAM_CACHE.setBinaryPath()
     app = QtGui.QApplication.instance() # retrieves the ipython qt application if any
     if app is None:
         app = QtGui.QApplication([]) # create one if standalone execution
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+import click
+
+from pyvi.octree import buildOctree
+
+# npy files of a dataset directory and the vertex attributes they are stored as
+ATTRIBUTE_FILES = [
+    ('coords', 'a_position'),
+    ('normals', 'a_normal'),
+    ('colors', 'a_color'),
+    ('intensity', 'a_intensity')
+]
+
+@click.command()
+@click.argument("dataset", type=click.Path(exists=True))
+@click.argument("output", type=click.Path())
+@click.option("--node-size", default=2**16, help="Maximum number of points per octree node")
+@click.option("--seed", default=0, help="Seed of the random point order")
+@click.option("--vertex-format", default='float', type=click.Choice(['float', 'compact']), help="Format the attributes are stored in")
+def cli(dataset, output, node_size, seed, vertex_format):
+    """Build a level of detail octree of the points in the npy files of DATASET, for the pvOctreePainter node"""
+    attributes = {}
+    for name, attribute in ATTRIBUTE_FILES:
+        path = os.path.join(dataset, name+'.npy')
+        if os.path.exists(path):
+            attributes[attribute] = np.load(path, mmap_mode='r')
+    if not 'a_position' in attributes:
+        raise click.BadParameter("no coords.npy in '{}'".format(dataset))
+    octree = buildOctree(attributes, output, node_size=node_size, seed=seed, vertex_format=vertex_format)
+    click.echo("{} points in {} nodes, {} levels".format(len(octree.points), len(octree), octree.nodes['level'].max()+1))
+
+if __name__ == '__main__':
+    cli()
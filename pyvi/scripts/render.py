@@ -0,0 +1,78 @@
+import os
+import json
+
+import numpy as np
+import click
+
+from PyQt5.QtGui import QImage
+from PyQt5.QtWidgets import QApplication
+
+from pyqtgraph.flowchart import Flowchart
+from pyqtgraph import configfile
+
+from pyvi.window import OffscreenWindow
+from pyvi.gloo import PROGRAM_CACHE
+
+from nodelib import LIBRARY
+from nodelib.pyvi import pvWindowNode
+
+def saveImage(image, path):
+    """Write a height x width x 4 uint8 array as png (or any format Qt knows by the extension of path), or as
+    a raw array if path ends with .npy"""
+    if path.endswith('.npy'):
+        np.save(path, image)
+    else:
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        QImage(image.data, width, height, 4*width, QImage.Format_RGBA8888).save(path)
+
+@click.command()
+@click.argument("flowchart", type=click.Path(exists=True))
+@click.argument("dataset", type=click.Path(exists=True))
+@click.argument("poses", type=click.Path(exists=True))
+@click.argument("output", type=click.Path())
+@click.option("--size", default=(800, 800), type=(int, int), help="Width and height of the images")
+@click.option("--format", "image_format", default='png', type=click.Choice(['png', 'jpg', 'npy']), help="Image format, npy writes the raw RGBA array")
+@click.option("--max-frames", default=1000, help="Maximum frames rendered per image while data is loading")
+@click.option("--tiled", default=None, type=(int, int), help="Render images of this width and height in tiles into memory-mapped npy files, for sizes beyond the framebuffer limits")
+@click.option("--program-cache", is_flag=True, help="Store compiled shader programs in the user cache directory, so the next run is faster")
+def cli(flowchart, dataset, poses, output, size, image_format, max_frames, tiled, program_cache):
+    """Render the window of a saved FLOWCHART applied to DATASET once for every camera pose in POSES, a json
+    list of pose dicts (see SimpleWindow.cameraPose, missing keys keep the previous value), to images in the
+    OUTPUT directory. Without a display, set QT_QPA_PLATFORM=offscreen."""
+    if program_cache:
+        PROGRAM_CACHE.setBinaryPath()
+    app = QApplication.instance()
+    if app is None:
+        app = QApplication([])
+
+    window = OffscreenWindow(size=size)
+
+    fc = Flowchart(library=LIBRARY, terminals={
+        'dataIn': {'io': 'in'}
+        })
+    fc.setInput(dataIn=dataset)
+    fc.restoreState(configfile.readConfigFile(flowchart), clear=False)
+    window_nodes = [node for node in fc.nodes().values() if type(node) is pvWindowNode]
+    if not window_nodes:
+        raise click.BadParameter("no pvWindow node in '{}'".format(flowchart))
+    for node in window_nodes:
+        node.setPyViWindow(window)
+    if hasattr(window, 'bbox'):
+        window.center(window.bbox)
+
+    with open(poses) as f:
+        poses = json.load(f)
+    if not os.path.exists(output):
+        os.makedirs(output)
+    with click.progressbar(poses, label='Rendering') as bar:
+        for i, pose in enumerate(bar):
+            window.setCameraPose(pose)
+            if tiled:
+                window.renderTiled(os.path.join(output, '{:06d}.npy'.format(i)), *tiled, max_frames=max_frames)
+            else:
+                saveImage(window.renderImage(max_frames), os.path.join(output, '{:06d}.{}'.format(i, image_format)))
+    window.delete()
+
+if __name__ == '__main__':
+    cli()
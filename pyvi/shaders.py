@@ -1,5 +1,5 @@
 import numpy as np
-from .gloo import ShaderProgram
+from .gloo import ShaderProgram, CAMERA_BLOCK, CAMERA_BINDING
 
 class PointShaderProgram(ShaderProgram):
     def __init__(self, **kwargs):
@@ -12,20 +12,19 @@ class PointShaderProgram(ShaderProgram):
             'color': [1.,1.,0.,1.]
         }
         super(PointShaderProgram, self).__init__()
+        self.uniform_blocks = {'Camera': CAMERA_BINDING}
         self.setOptions(**kwargs)
 
     def setOptions(self, **kwargs):
         self.options.update(kwargs)
 
         self.attribute_names = ['a_position']
-        self.uniform_names = ['u_model', 'u_view', 'u_projection', 'u_point_size']
+        self.uniform_names = ['u_point_size']
         
         self.s_defines = ""
         for key, value in self.options.items():
             if key == 'draw_mode':
                 self.s_defines += "#define {}\n".format(key+'_'+value)
-                if value in ['oriented_disk', 'disk']:
-                    self.uniform_names += ['u_model_scale']
             elif key == 'color_mode':
                 self.s_defines += "#define {}\n".format(key+'_'+value)
                 if value == 'fixed':
@@ -61,15 +60,9 @@ class PointShaderProgram(ShaderProgram):
 
         // Uniforms
         // ------------------------------------
-        uniform highp mat4 u_model;
-        uniform highp mat4 u_view;
-        uniform highp mat4 u_projection;
+        {camera}
         uniform float u_point_size;
 
-        #if defined(draw_mode_oriented_disk) | defined(draw_mode_disk)
-        uniform float u_model_scale;
-        #endif
-
         #if defined(color_mode_fixed)
         uniform lowp vec4 u_color;
         #endif
@@ -144,7 +137,7 @@ class PointShaderProgram(ShaderProgram):
                 v_normal = n;
             #endif
         }}
-        """.format(defines=self.s_defines)
+        """.format(defines=self.s_defines, camera=CAMERA_BLOCK)
 
     @property
     def fragmentShaderSource(self):
@@ -213,13 +206,14 @@ class LineShaderProgram(ShaderProgram):
             'color': [1.,1.,0.,1.]
         }
         super(LineShaderProgram, self).__init__()
+        self.uniform_blocks = {'Camera': CAMERA_BINDING}
         self.setOptions(**kwargs)
         
     def setOptions(self, **kwargs):
         self.options.update(kwargs)
 
         self.attribute_names = ['a_position']
-        self.uniform_names = ['u_model', 'u_view', 'u_projection']
+        self.uniform_names = []
         
         self.s_defines = ""
         for key, value in self.options.items():
@@ -253,9 +247,7 @@ class LineShaderProgram(ShaderProgram):
 
         // Uniforms
         // ------------------------------------
-        uniform mat4 u_model;
-        uniform mat4 u_view;
-        uniform mat4 u_projection;
+        {camera}
         
         #if defined(color_mode_fixed)
         uniform vec4 u_color;
@@ -296,7 +288,7 @@ class LineShaderProgram(ShaderProgram):
             
             gl_Position = u_projection * u_view * u_model * vec4(a_position, 1.0);    
         }}
-        """.format(s_defines=self.s_defines)
+        """.format(s_defines=self.s_defines, camera=CAMERA_BLOCK)
 
     @property
     def fragmentShaderSource(self):
@@ -334,13 +326,14 @@ class TriangleShaderProgram(ShaderProgram):
             'lightning': True
         }
         super(TriangleShaderProgram, self).__init__()
+        self.uniform_blocks = {'Camera': CAMERA_BINDING}
         self.setOptions(**kwargs)
         
     def setOptions(self, **kwargs):
         self.options.update(kwargs)
 
         self.attribute_names = ['a_position']
-        self.uniform_names = ['u_model', 'u_view', 'u_projection']
+        self.uniform_names = []
         
         self.s_defines = ""
         for key, value in self.options.items():
@@ -374,9 +367,7 @@ class TriangleShaderProgram(ShaderProgram):
 
         // Uniforms
         // ------------------------------------
-        uniform mat4 u_model;
-        uniform mat4 u_view;
-        uniform mat4 u_projection;
+        {camera}
         uniform lowp vec4 u_color;
 
         // Attributes
@@ -400,7 +391,7 @@ class TriangleShaderProgram(ShaderProgram):
         v_color = u_color;
         #endif
         }}
-        """.format(s_defines=self.s_defines)
+        """.format(s_defines=self.s_defines, camera=CAMERA_BLOCK)
 
     @property
     def fragmentShaderSource(self):
@@ -419,3 +410,234 @@ class TriangleShaderProgram(ShaderProgram):
         """.format(s_defines=self.s_defines)
 
         
+class PickShaderProgram(ShaderProgram):
+    """Writes the painter id and gl_VertexID of each fragment to an unsigned integer color buffer, see
+    SimpleWindow.pick. Points get the size they have in the PointShaderProgram of their painter."""
+
+    def __init__(self):
+        super(PickShaderProgram, self).__init__()
+        self.uniform_blocks = {'Camera': CAMERA_BINDING}
+        self.attribute_names = ['a_position']
+        self.uniform_names = ['u_painter_id', 'u_point_size', 'u_scaled_size', 'u_instanced']
+
+    def setPainter(self, painter_id, program):
+        """Set the uniforms to draw the painter with index painter_id, which is drawn with program"""
+        self.setUniformValue('u_painter_id', painter_id)
+        self.setUniformValue('u_instanced', False)
+        options = getattr(program, 'options', {})
+        self.setUniformValue('u_point_size', options.get('point_size', 1.))
+        self.setUniformValue('u_scaled_size', options.get('draw_mode') in ['oriented_disk', 'disk'])
+
+    @property
+    def vertexShaderSource(self):
+        return 'vertex', """
+        #version 330
+
+        {camera}
+        uniform float u_point_size;
+        uniform bool u_scaled_size;
+        // the vertex id is gl_InstanceID, for painters that draw an instance per vertex
+        uniform bool u_instanced;
+
+        in vec3 a_position;
+
+        flat out uint v_vertex_id;
+
+        void main (void) {{
+            vec4 posEye = u_view * u_model * vec4(a_position, 1.0);
+            gl_Position = u_projection * posEye;
+            if (u_scaled_size) {{
+                vec4 projCorner = u_projection * vec4(u_model_scale, u_model_scale, posEye.z, posEye.w);
+                gl_PointSize = projCorner.x * 2.0 * u_point_size / projCorner.w;
+            }} else {{
+                gl_PointSize = u_point_size;
+            }}
+            v_vertex_id = uint(u_instanced ? gl_InstanceID : gl_VertexID);
+        }}
+        """.format(camera=CAMERA_BLOCK)
+
+    @property
+    def fragmentShaderSource(self):
+        return 'fragment', """
+        #version 330
+
+        uniform uint u_painter_id;
+
+        flat in uint v_vertex_id;
+
+        out uvec2 id;
+
+        void main()
+        {
+            id = uvec2(u_painter_id, v_vertex_id);
+        }
+        """
+
+class BallShaderProgram(ShaderProgram):
+    """Ray-casts a sphere per instance, see BallPainter. Each instance is a quad facing the camera that covers
+    the outline of the ball, its corners follow from gl_VertexID so no vertex data is needed for the quad."""
+
+    def __init__(self, **kwargs):
+
+        self.options = {
+            'color_mode': 'fixed', # or texture, color
+            'lightning': True,
+            'radius_scale': 1.0,
+            'color': [1.,1.,0.,1.]
+        }
+        super(BallShaderProgram, self).__init__()
+        self.uniform_blocks = {'Camera': CAMERA_BINDING}
+        self.setOptions(**kwargs)
+
+    def setOptions(self, **kwargs):
+        self.options.update(kwargs)
+
+        self.attribute_names = ['a_position', 'a_radius']
+        self.uniform_names = ['u_radius_scale']
+
+        self.s_defines = ""
+        for key, value in self.options.items():
+            if key == 'color_mode':
+                self.s_defines += "#define {}\n".format(key+'_'+value)
+                if value == 'fixed':
+                    self.uniform_names += ['u_color']
+                elif value == 'texture':
+                    self.attribute_names += ['a_intensity']
+                elif value == 'color':
+                    self.attribute_names += ['a_color']
+            elif key == 'lightning':
+                if value:
+                    self.s_defines += "#define {}\n".format(key)
+
+    def initialise(self):
+        ShaderProgram.initialise(self)
+        self.setUniformValue('u_radius_scale', self.options['radius_scale'])
+        if self.options['color_mode'] == 'fixed':
+            self.setUniformValue('u_color', np.array(self.options['color'], dtype=np.float32))
+
+    def rebuild(self, **kwargs):
+        self.delete()
+        self.setOptions(**kwargs)
+
+    @property
+    def vertexShaderSource(self):
+        return 'vertex', """
+        #version 330
+
+        {defines}
+
+        // Uniforms
+        // ------------------------------------
+        {camera}
+        uniform float u_radius_scale;
+
+        #if defined(color_mode_fixed)
+        uniform lowp vec4 u_color;
+        #endif
+
+        // Attributes, one per instance
+        // ------------------------------------
+        in vec3 a_position;
+        in float a_radius;
+        #if defined(color_mode_texture)
+        in float a_intensity;
+        #elif defined(color_mode_color)
+        in lowp vec4 a_color;
+        #endif
+
+        // Varyings
+        // ------------------------------------
+        #if defined(color_mode_texture)
+        flat out float v_color_intensity;
+        #else
+        flat out vec4 v_color;
+        #endif
+        flat out vec3 v_center;
+        flat out float v_radius;
+        out vec3 v_position;
+
+        void main (void) {{
+            // the view matrix scales by u_model_scale
+            vec3 center = (u_view * u_model * vec4(a_position, 1.0)).xyz;
+            float radius = a_radius * u_radius_scale * u_model_scale;
+
+            // quad through the center facing the camera, large enough for the cone from the camera
+            // that touches the ball
+            float d = length(center);
+            vec3 w = -center / d;
+            vec3 u = normalize(cross(abs(w.y) < 0.99 ? vec3(0,1,0) : vec3(1,0,0), w));
+            vec3 v = cross(w, u);
+            float half_size = radius * d / sqrt(max(d*d - radius*radius, 1e-12));
+            vec2 corner = vec2(gl_VertexID & 1, gl_VertexID >> 1) * 2.0 - 1.0;
+            vec3 position = center + half_size * (corner.x * u + corner.y * v);
+            gl_Position = u_projection * vec4(position, 1.0);
+            if (d <= radius) {{
+                // the camera is inside the ball, it is not drawn
+                gl_Position = vec4(0.0, 0.0, 2.0, 1.0);
+            }}
+
+            v_center = center;
+            v_radius = radius;
+            v_position = position;
+            #if defined(color_mode_texture)
+                v_color_intensity = a_intensity;
+            #elif defined(color_mode_fixed)
+                v_color = u_color;
+            #elif defined(color_mode_color)
+                v_color = a_color;
+            #endif
+        }}
+        """.format(defines=self.s_defines, camera=CAMERA_BLOCK)
+
+    @property
+    def fragmentShaderSource(self):
+        return 'fragment', """
+        #version 330
+
+        {defines}
+
+        {camera}
+
+        #if defined(color_mode_texture)
+        uniform sampler1D u_colormap;
+        flat in float v_color_intensity;
+        #else
+        flat in vec4 v_color;
+        #endif
+        flat in vec3 v_center;
+        flat in float v_radius;
+        in vec3 v_position;
+
+        out vec4 color;
+
+        void main()
+        {{
+            // first hit of the ray from the camera through this fragment
+            vec3 ray = normalize(v_position);
+            float b = dot(ray, v_center);
+            float discriminant = b*b - dot(v_center, v_center) + v_radius*v_radius;
+            if (discriminant < 0.0) {{
+                discard;
+            }}
+            vec3 hit = (b - sqrt(discriminant)) * ray;
+
+            vec4 clip = u_projection * vec4(hit, 1.0);
+            gl_FragDepth = 0.5 * (gl_DepthRange.diff * clip.z / clip.w + gl_DepthRange.near + gl_DepthRange.far);
+
+            #if defined(lightning)
+                vec3 n = (hit - v_center) / v_radius;
+                vec3 lighting_direction_1 = vec3(1,1,1);
+                vec3 lighting_direction_2 = vec3(0,0.5,1);
+                float L = dot(n, normalize(lighting_direction_1)) + dot(n, normalize(lighting_direction_2));
+                float lightpwr = clamp(abs(L), 0.3, 1);
+            #else
+                float lightpwr = 1.0;
+            #endif
+
+            #if defined(color_mode_texture)
+                color = vec4(lightpwr, lightpwr, lightpwr, 1.0)*texture(u_colormap, v_color_intensity);
+            #else
+                color = vec4(lightpwr, lightpwr, lightpwr, 1.0)*v_color;
+            #endif
+        }}
+        """.format(defines=self.s_defines, camera=CAMERA_BLOCK)
@@ -21,6 +21,30 @@ class BBox(object):
         self.center = self.mi + self.width/2
         self.is_empty = False
 
+    def contains(self, points):
+        """Mask of the points (n x 3) that are inside the box or on its faces"""
+        return np.all(np.logical_and(self.mi <= points, points <= self.ma), axis=1)
+
+    def intersectsFrustum(self, planes):
+        """Test against the planes returned by frustumPlanes, may give false positives near the frustum corners"""
+        return bool(boxesInFrustum(planes, self.mi[None], self.ma[None])[0])
+
+def frustumPlanes(mvp):
+    """Planes (a,b,c,d) of the view frustum of model-view-projection matrix mvp, which transforms row vectors
+    as in v.dot(mvp). A point is inside the frustum if a*x + b*y + c*z + d >= 0 for all 6 planes"""
+    m = np.asarray(mvp, dtype=np.float64).T
+    return np.array([m[3]+m[0], m[3]-m[0], m[3]+m[1], m[3]-m[1], m[3]+m[2], m[3]-m[2]])
+
+def boxesInFrustum(planes, mi, ma):
+    """Mask of the axis aligned boxes with corners mi and ma (n x 3 arrays) that are not completely outside a plane"""
+    inside = np.ones(len(mi), dtype=bool)
+    for plane in planes:
+        normal = plane[:3]
+        # the corner furthest along the plane normal
+        corner = np.where(normal >= 0, ma, mi)
+        inside &= corner.dot(normal) + plane[3] >= 0
+    return inside
+
 
 class Shader(object):
     vertexShaderSource = '''
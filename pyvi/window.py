@@ -1,16 +1,20 @@
-from PyQt5.QtCore import QEvent, Qt
-from PyQt5.QtGui import (QGuiApplication, QMatrix4x4, QOpenGLContext,
-        QSurfaceFormat, QWindow)
+from PyQt5.QtCore import QEvent, Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import (QColor, QFont, QGuiApplication, QMatrix4x4, QOffscreenSurface, QOpenGLContext,
+        QOpenGLPaintDevice, QPainter, QSurfaceFormat, QWindow)
 from PyQt5.QtWidgets import QApplication, QTreeWidget, QTreeWidgetItem, QAbstractItemView, QDockWidget
 
 from OpenGL import GL as gl
 import ctypes
 import numpy as np
+from numpy.lib.format import open_memmap
 import math
+import time
 
 from .linalg import quaternion as q
 from .transforms import *
 from .gloo import *
+from .shaders import PickShaderProgram
+from .profiler import FrameProfiler, painterName
 
 # import threading
 
@@ -21,6 +25,16 @@ DEFAULT_FORMAT.setStereo(False)
 DEFAULT_FORMAT.setSwapBehavior(QSurfaceFormat.DoubleBuffer)
 DEFAULT_FORMAT.setDepthBufferSize(24)
 DEFAULT_FORMAT.setSamples(4)
+# swapBuffers waits for vsync, which paces the frames requested with renderLater
+DEFAULT_FORMAT.setSwapInterval(1)
+
+# frame intervals longer than this (in seconds) are idle time and do not count towards the frame rate
+FRAME_IDLE_INTERVAL = 0.5
+
+# seconds between updates of the profile in the layer tree
+PROFILE_DISPLAY_INTERVAL = 0.5
+# painters listed in the profile overlay
+PROFILE_HUD_LINES = 10
 
 class OpenGLWindow(QWindow):
     def __init__(self, parent=None):
@@ -31,6 +45,12 @@ class OpenGLWindow(QWindow):
         self.m_context = None
         self.m_gl = None
 
+        # average time between consecutive frames, None until two frames were rendered in a row
+        self.m_frame_interval = None
+        self.m_last_frame_time = None
+        # render requests that were merged into an already pending frame
+        self.m_dropped_events = 0
+
         self.setSurfaceType(QWindow.OpenGLSurface)
 
     def initialise(self):
@@ -43,9 +63,35 @@ class OpenGLWindow(QWindow):
             self.renderLater()
 
     def renderLater(self):
+        """Schedule a frame, requests made before it is rendered are coalesced into it"""
         if not self.m_update_pending:
             self.m_update_pending = True
-            QApplication.postEvent(self, QEvent(QEvent.UpdateRequest))
+            # delivered as an UpdateRequest, paced by the platform to the display refresh
+            self.requestUpdate()
+        else:
+            self.m_dropped_events += 1
+
+    def frameRate(self):
+        """Frames per second while rendering continuously, 0 if unknown"""
+        if self.m_frame_interval is None:
+            return 0.
+        return 1./self.m_frame_interval
+
+    def droppedEvents(self):
+        """Number of render requests that were coalesced into a pending frame"""
+        return self.m_dropped_events
+
+    def defaultFramebuffer(self):
+        """The framebuffer object frames are rendered into"""
+        return self.m_context.defaultFramebufferObject()
+
+    def makeCurrent(self):
+        """Make the context current outside of renderNow, the window needs to have been rendered once"""
+        if self.m_context is None:
+            raise Exception('The window has no OpenGL context yet')
+        self.m_context.makeCurrent(self)
+        # the binding cache of this context, another window's context may have been current
+        makeStateCurrent()
 
     def renderNow(self):
         if not self.isExposed():
@@ -63,6 +109,8 @@ class OpenGLWindow(QWindow):
             needsInitialise = True
 
         self.m_context.makeCurrent(self)
+        # the counters of the state cache cover one frame
+        makeStateCurrent().resetCounters()
 
         if needsInitialise:
             self.initialise()
@@ -71,6 +119,16 @@ class OpenGLWindow(QWindow):
 
         self.m_context.swapBuffers(self)
 
+        now = time.perf_counter()
+        if not self.m_last_frame_time is None:
+            interval = now - self.m_last_frame_time
+            if interval < FRAME_IDLE_INTERVAL:
+                if self.m_frame_interval is None:
+                    self.m_frame_interval = interval
+                else:
+                    self.m_frame_interval = 0.9*self.m_frame_interval + 0.1*interval
+        self.m_last_frame_time = now
+
         if self.m_animating:
             self.renderLater()
 
@@ -85,7 +143,7 @@ class OpenGLWindow(QWindow):
         self.renderNow()
 
     def resizeEvent(self, event):
-        self.renderNow()
+        self.renderLater()
 
 class crosshairPainter(Painter):
     vertexShaderSource = 'vertex', """
@@ -119,6 +177,11 @@ void main()
         super(crosshairPainter, self).__init__(shader_program, 'lines', buffer)
 
 class SimpleWindow(OpenGLWindow):
+    # fraction of the queued buffer data that has been uploaded
+    sigUploadProgress = pyqtSignal(float)
+    # (painter, vertex index) under the cursor after a pick, or None if there was nothing
+    sigPicked = pyqtSignal(object)
+
     def __init__(self, format=DEFAULT_FORMAT, size=(700,700)):
         super(SimpleWindow, self).__init__()
 
@@ -132,6 +195,13 @@ class SimpleWindow(OpenGLWindow):
         # scene.window = self
         self.layers = []
 
+        # buffer uploads are spread over frames so large datasets do not block the event loop
+        self.upload_queue = UploadQueue()
+        # compatible painters are drawn together from shared buffers
+        self.batcher = PainterBatcher()
+        # camera matrices shared by all programs, updated once per frame
+        self.camera = CameraBuffer()
+
         # background color
         self.clearcolor = (1,1,1,1)
 
@@ -152,9 +222,41 @@ class SimpleWindow(OpenGLWindow):
 
         self.last_mouse_pos = None
 
+        # while the camera moves at most this many points are drawn, full detail returns after idle_timer fires
+        self.interaction_points = 4*10**6
+        self.is_interacting = False
+        self.detail = 1.
+        self.idle_timer = QTimer()
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(250)
+        self.idle_timer.timeout.connect(self.idle)
+
+        # while a tiled image is rendered, the part of the view rendered as [left, right, bottom, top] fractions
+        # and the size of the tile in pixels
+        self.tile = None
+        self.tile_size = None
+        self.max_viewport_dims = None
+
+        # per painter GPU and CPU times, while profiling is on, see setProfiling
+        self.profiler = FrameProfiler()
+        self.is_profiling = False
+        self.show_profile_hud = False
+        self.last_profile_display = 0.
+
+        # picking renders painter and vertex ids around the cursor offscreen, the result is read back a frame later
+        self.pick_radius = 4
+        self.pick_program = PickShaderProgram()
+        self.pick_framebuffer = FrameBuffer(*size, internal_format=gl.GL_RG32UI)
+        self.pixel_reader = PixelReader()
+        self.pick_position = None
+        self.pick_painters = []
+        self.pick_center = None
+
         # self.disableCentering = False
 
         self.layerWidget = QTreeWidget()
+        # the second column shows the profile of each painter
+        self.layerWidget.setColumnCount(2)
         self.layerWidget.headerItem().setHidden(True)
         self.layerWidget.setSelectionMode(QAbstractItemView.MultiSelection)
         self.layerWidget.itemClicked.connect(self.updateLayerVisibility)
@@ -185,6 +287,7 @@ class SimpleWindow(OpenGLWindow):
         item.setSelected(layer.is_visible)
         for painter in layer.painters:
             child_item = QTreeWidgetItem([painter.name()], 0)
+            painter.tree_item = child_item
             item.addChild(child_item)
             child_item.setSelected(painter.is_visible)
         self.layerWidget.expandItem(item)
@@ -206,6 +309,12 @@ class SimpleWindow(OpenGLWindow):
 
     def initialise(self):
         self.crosshair_painter = crosshairPainter()
+        self.setupGL()
+        self.max_viewport_dims = tuple(int(d) for d in gl.glGetIntegerv(gl.GL_MAX_VIEWPORT_DIMS))
+        self.center()
+        self.renderLater()
+
+    def setupGL(self):
         gl.glClearColor(*self.clearcolor)
         gl.glEnable(gl.GL_PROGRAM_POINT_SIZE)
         gl.glDepthMask(gl.GL_TRUE)
@@ -213,9 +322,6 @@ class SimpleWindow(OpenGLWindow):
         gl.glDepthFunc(gl.GL_LESS)
         # gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
         # gl.glEnable(gl.GL_BLEND)
-        print(gl.glGetIntegerv(gl.GL_MAX_VIEWPORT_DIMS))
-        self.center()
-        self.renderLater()
 
     def center(self, bbox=None):
         # if not self.disableCentering:
@@ -234,12 +340,148 @@ class SimpleWindow(OpenGLWindow):
     def setClearColor(self, color):
         self.clearcolor = color
 
+    def cameraPose(self):
+        """The view and projection parameters as a dict of lists and floats, eg to store as json"""
+        w, (x, y, z) = self.v_rotation
+        return {
+            'rotation': [w, x, y, z],
+            'translation': [float(v) for v in self.v_translation],
+            'scale': float(self.v_scale),
+            'distance': float(self.v_cam_distance),
+            'fov': float(self.p_fov)
+        }
+
+    def setCameraPose(self, pose):
+        """Set the parameters of a cameraPose() dict, missing keys are left as they are"""
+        if 'rotation' in pose:
+            w, x, y, z = pose['rotation']
+            self.v_rotation = w, (x, y, z)
+        if 'translation' in pose:
+            self.v_translation = np.array(pose['translation'], dtype=np.float32)
+        self.v_scale = pose.get('scale', self.v_scale)
+        self.v_cam_distance = pose.get('distance', self.v_cam_distance)
+        self.p_fov = pose.get('fov', self.p_fov)
+        self.renderLater()
+
+    def interact(self):
+        """Called when the camera moves, points are drawn subsampled until the input has been idle for a while"""
+        self.is_interacting = True
+        self.idle_timer.start()
+
+    def idle(self):
+        self.is_interacting = False
+        self.renderLater()
+
+    def setProfiling(self, enabled, hud=True, log_path=None):
+        """Measure the GPU and CPU time and vertices of each painter render, shown in the layer tree and, if hud
+        is set, on top of the view. With log_path every measurement is written to a csv file. The results are
+        available from self.profiler. While profiling, frames are rendered continuously."""
+        self.is_profiling = enabled
+        self.show_profile_hud = enabled and hud
+        self.profiler.setLog(log_path if enabled else None)
+        if not enabled:
+            for layer in self.layers:
+                for painter in layer.painters:
+                    if hasattr(painter, 'tree_item'):
+                        painter.tree_item.setText(1, '')
+        self.renderLater()
+
+    def updateProfileTree(self):
+        batches = {}
+        for batch in self.batcher.batches.values():
+            for painter in batch.members:
+                batches[painter] = batch
+        for layer in self.layers:
+            for painter in layer.painters:
+                if not hasattr(painter, 'tree_item'):
+                    continue
+                stats = self.profiler.painterStats(batches.get(painter, painter))
+                if stats is None:
+                    painter.tree_item.setText(1, '')
+                    continue
+                text = '{:.2f} ms gpu, {:.2f} ms cpu, {} vertices'.format(*stats)
+                if painter in batches:
+                    text += ' (batch)'
+                painter.tree_item.setText(1, text)
+
+    def renderProfileHUD(self):
+        """Draw the slowest painters on top of the frame"""
+        lines = ['{:.1f} fps'.format(self.frameRate())]
+        for painter, gpu, cpu, vertices in self.profiler.results()[:PROFILE_HUD_LINES]:
+            lines.append('{:7.2f} ms gpu {:7.2f} ms cpu {:>10} vertices  {}'.format(gpu, cpu, vertices, painterName(painter)))
+        device = QOpenGLPaintDevice(*self.viewportSize())
+        painter = QPainter(device)
+        painter.setFont(QFont('Monospace', 9))
+        painter.setPen(QColor(255, 255, 255) if sum(self.clearcolor[:3]) < 1.5 else QColor(0, 0, 0))
+        for i, line in enumerate(lines):
+            painter.drawText(8, 16*(i+1), line)
+        painter.end()
+        # QPainter changes GL state behind the back of the state cache
+        glState().invalidate()
+        self.setupGL()
+
+    def setUploadBudget(self, nbytes):
+        """Set the maximum number of bytes uploaded to the GPU per frame"""
+        self.upload_queue.budget = nbytes
+
+    def pick(self, x, y):
+        """Find the painter and vertex at window position x, y, the result is emitted with sigPicked"""
+        self.pick_position = x, y
+        self.renderLater()
+
+    def renderPick(self, painters):
+        x, y = self.pick_position
+        self.pick_position = None
+        # framebuffer rows start at the bottom
+        y = self.height()-1 - y
+        r = self.pick_radius
+        x0, y0 = max(0, x-r), max(0, y-r)
+        x1, y1 = min(self.width(), x+r+1), min(self.height(), y+r+1)
+        if x1 <= x0 or y1 <= y0:
+            return
+        if not self.pick_program.is_initialised:
+            self.pick_program.initialise()
+
+        self.pick_framebuffer.resize(self.width(), self.height())
+        self.pick_framebuffer.bind()
+        gl.glEnable(gl.GL_SCISSOR_TEST)
+        gl.glScissor(x0, y0, x1-x0, y1-y0)
+        # id 0 is the background
+        gl.glClearBufferuiv(gl.GL_COLOR, 0, np.zeros(4, dtype=np.uint32))
+        gl.glClear(gl.GL_DEPTH_BUFFER_BIT)
+        for i, painter in enumerate(painters):
+            self.pick_program.setPainter(i+1, painter.program)
+            painter.renderID(self.pick_program)
+        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
+        self.pixel_reader.read(x0, y0, x1-x0, y1-y0, gl.GL_RG_INTEGER, gl.GL_UNSIGNED_INT, np.uint32, 2)
+        gl.glDisable(gl.GL_SCISSOR_TEST)
+        self.pick_framebuffer.release(self.defaultFramebuffer())
+
+        self.pick_painters = list(painters)
+        self.pick_center = x-x0, y-y0
+
+    def pollPick(self):
+        pixels = self.pixel_reader.poll()
+        if pixels is None:
+            if self.pixel_reader.is_pending:
+                self.renderLater()
+            return
+        rows, cols = np.nonzero(pixels[:,:,0])
+        if not len(rows):
+            self.sigPicked.emit(None)
+            return
+        # the hit closest to the cursor
+        cx, cy = self.pick_center
+        i = np.argmin((cols-cx)**2 + (rows-cy)**2)
+        painter_id, vertex_id = pixels[rows[i], cols[i]]
+        self.sigPicked.emit(self.pick_painters[painter_id-1].pick(int(vertex_id)))
+
     def render(self):
         # if self.scene.is_changed:
         #     self.center(self.scene.bbox)
         #     self.scene.is_changed = False
 
-        gl.glViewport(0, 0, self.width(), self.height())
+        gl.glViewport(0, 0, *self.viewportSize())
 
         gl.glClearColor(*self.clearcolor)
         
@@ -251,16 +493,122 @@ class SimpleWindow(OpenGLWindow):
         bits |= gl.GL_STENCIL_BUFFER_BIT
         gl.glClear(bits)
 
-        for layer in self.layers:
-            if layer.is_visible:
-                for painter in layer.painters:
-                    if painter.is_visible:
-                        painter.render(view=self)
+        painters = self.batcher.painters(self.layers)
+
+        self.detail = 1.
+        if self.is_interacting:
+            # the visible chunks, octree nodes and balls of the last frame
+            n_points = sum(painter.subsampledVertices() for painter in painters)
+            if n_points > self.interaction_points:
+                self.detail = self.interaction_points / float(n_points)
+
+        uploaded = self.upload_queue.drain()
+        # buffers released while another context was current
+        BUFFER_POOL.trim()
+
+        self.camera.setMatrices(self.mat_model, self.mat_view, self.mat_projection, self.v_scale)
+        self.camera.bind()
+
+        for painter in painters:
+            if self.is_profiling:
+                self.profiler.begin(painter)
+                painter.render(view=self)
+                self.profiler.end(painter.drawn_vertices)
+            else:
+                painter.render(view=self)
         if self.crosshair_painter.is_visible:
             self.crosshair_painter.render()
 
+        if self.is_profiling:
+            self.profiler.endFrame()
+            now = time.perf_counter()
+            if now - self.last_profile_display > PROFILE_DISPLAY_INTERVAL:
+                self.last_profile_display = now
+                self.updateProfileTree()
+            if self.show_profile_hud:
+                self.renderProfileHUD()
+            # results arrive a few frames late
+            self.renderLater()
+
+        # a pick started last frame is usually ready by now
+        if self.pixel_reader.is_pending:
+            self.pollPick()
+        if not self.pick_position is None:
+            self.renderPick(painters)
+            self.renderLater()
+
         self.m_frame += 1
 
+        # keep rendering until all data is on the GPU
+        if not self.upload_queue.isEmpty():
+            self.sigUploadProgress.emit(self.upload_queue.progress())
+            self.renderLater()
+        elif uploaded:
+            self.sigUploadProgress.emit(1.)
+
+    def renderFrames(self, max_frames=1000):
+        """Render frames until no new frame is asked for (eg while data is uploaded), at most max_frames"""
+        for i in range(max_frames):
+            self.m_update_pending = False
+            self.render()
+            if not self.m_update_pending:
+                break
+
+    def viewportSize(self):
+        """Width and height in pixels of what is being rendered, a tile or the window"""
+        if not self.tile_size is None:
+            return self.tile_size
+        return self.width(), self.height()
+
+    def renderTiled(self, path, width, height, tile_size=None, max_frames=1000):
+        """Render the view at width x height pixels, eg for posters beyond the maximum framebuffer size, into
+        an npy file at path. The image is rendered in tiles of at most tile_size pixels that each get their own
+        part of the view frustum. Each tile is read back while the next one renders and is written to the
+        memory-mapped file, so the image is never in memory as a whole. Returns the memory-mapped image, a
+        height x width x 4 uint8 array with the top row first."""
+        self.makeCurrent()
+        if tile_size is None:
+            tile_size = min(min(self.max_viewport_dims), int(gl.glGetIntegerv(gl.GL_MAX_RENDERBUFFER_SIZE)), 4096)
+        image = open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 4))
+        framebuffer = FrameBuffer(min(tile_size, width), min(tile_size, height))
+        # tiles alternate between two readers, so a tile is read back while the next one renders
+        readers = [PixelReader(), PixelReader()]
+        p_ratio, crosshair_visible = self.p_ratio, self.crosshair_painter.is_visible
+        self.p_ratio = width/height
+        self.crosshair_painter.is_visible = False
+        try:
+            framebuffer.bind()
+            pending = None
+            tiles = [(x, y) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+            for i, (x, y) in enumerate(tiles):
+                w, h = min(tile_size, width-x), min(tile_size, height-y)
+                self.tile = x/width, (x+w)/width, y/height, (y+h)/height
+                self.tile_size = w, h
+                self.renderFrames(max_frames)
+                gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
+                readers[i % 2].read(0, 0, w, h, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, np.uint8, 4)
+                if not pending is None:
+                    self.writeTile(image, *pending)
+                pending = readers[i % 2], x, y
+            if not pending is None:
+                self.writeTile(image, *pending)
+        finally:
+            self.tile = self.tile_size = None
+            self.p_ratio, self.crosshair_painter.is_visible = p_ratio, crosshair_visible
+            framebuffer.release(self.defaultFramebuffer())
+            framebuffer.delete()
+            for reader in readers:
+                reader.delete()
+        image.flush()
+        self.renderLater()
+        return image
+
+    def writeTile(self, image, reader, x, y):
+        # tiles are read with the bottom row first, from the bottom of the image
+        pixels = reader.poll(wait=True)
+        h, w = pixels.shape[:2]
+        image[len(image)-y-h:len(image)-y, x:x+w] = pixels[::-1]
+
     def screen2view(self, x,y):
         w, h = self.width(), self.height()
         r = 2*self.radius
@@ -285,7 +633,13 @@ class SimpleWindow(OpenGLWindow):
 
     @property
     def mat_projection(self):
-        return perspective(self.p_fov, self.p_ratio, self.p_nclip, self.p_fclip)
+        if self.tile is None:
+            return perspective(self.p_fov, self.p_ratio, self.p_nclip, self.p_fclip)
+        # the part of the perspective frustum of the tile
+        top = math.tan(math.radians(self.p_fov)/2.) * self.p_nclip
+        right = top * self.p_ratio
+        x0, x1, y0, y1 = self.tile
+        return frustum(right*(2*x0-1), right*(2*x1-1), top*(2*y0-1), top*(2*y1-1), self.p_nclip, self.p_fclip)
 
     def computeMVPMatrix(self):
         mvp_matrix = np.eye(4, dtype=np.float32)
@@ -294,13 +648,12 @@ class SimpleWindow(OpenGLWindow):
         # view
         mvp_matrix = mvp_matrix.dot(self.mat_view)
         # projection
-        projection = perspective(self.p_fov, self.p_ratio, self.p_nclip, self.p_fclip)
-        return mvp_matrix.dot(projection)
+        return mvp_matrix.dot(self.mat_projection)
     
     def resizeEvent(self, event):
         size = event.size()
         self.p_ratio = size.width()/size.height()
-        self.renderNow()
+        self.renderLater()
 
     def wheelEvent(self, event):        
         modifiers = event.modifiers()
@@ -316,7 +669,12 @@ class SimpleWindow(OpenGLWindow):
             self.v_scale *= (ticks/30 + 1.)
             self.v_scale = max(1E-3, self.v_scale)
             self.v_scale = min(1E3, self.v_scale)
-        self.renderNow()
+        self.interact()
+        self.renderLater()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton and event.modifiers() == Qt.ControlModifier:
+            self.pick(event.x(), event.y())
 
     def mouseMoveEvent(self, event):
         modifiers = event.modifiers()
@@ -337,6 +695,7 @@ class SimpleWindow(OpenGLWindow):
             #multiply with inverse view matrix and apply translation in world coordinates
             self.v_translation += np.array([dx/r, -dy/r, 0., 0.]).dot( np.linalg.inv(self.mat_view)) [:3]
             self.crosshair_painter.is_visible = True
+            self.interact()
         elif Qt.LeftButton == buttons:
             x0,y0 = self.screen2view(*self.last_mouse_pos)
             x1,y1 = self.screen2view(pos_x, pos_y)
@@ -346,11 +705,12 @@ class SimpleWindow(OpenGLWindow):
 
             self.v_rotation = q.product(v1, v0, self.v_rotation)
             self.crosshair_painter.is_visible = True
+            self.interact()
         else:
             self.crosshair_painter.is_visible = False
         
         self.last_mouse_pos = pos_x, pos_y
-        self.renderNow()
+        self.renderLater()
 
     def keyPressEvent(self, event):
         key = event.key()
@@ -360,4 +720,73 @@ class SimpleWindow(OpenGLWindow):
         elif key == Qt.Key_U:
             if hasattr(self, 'bbox'):
                 self.center(self.bbox)
-        self.renderNow()
\ No newline at end of file
+        elif key == Qt.Key_P:
+            self.setProfiling(not self.is_profiling)
+        self.renderLater()
+
+class OffscreenWindow(SimpleWindow):
+    """SimpleWindow that renders into a framebuffer object on an offscreen surface, so images can be rendered
+    without showing the window or without a display at all (eg with QT_QPA_PLATFORM=offscreen and a software
+    OpenGL like Mesa's llvmpipe)"""
+    def __init__(self, format=DEFAULT_FORMAT, size=(700,700)):
+        super(OffscreenWindow, self).__init__(format, size)
+        self.surface = QOffscreenSurface()
+        self.surface.setFormat(format)
+        self.surface.create()
+        self.framebuffer = FrameBuffer(*size)
+        self.image_reader = PixelReader()
+        self.setSize(*size)
+
+    def setSize(self, width, height):
+        # there are no resize events for a window that is not shown
+        self.resize(width, height)
+        self.p_ratio = width/height
+
+    def renderLater(self):
+        # renderImage renders another frame while this is set
+        self.m_update_pending = True
+
+    def defaultFramebuffer(self):
+        if not self.framebuffer.is_initialised:
+            return 0
+        return self.framebuffer.framebuffer
+
+    def makeCurrent(self):
+        needsInitialise = False
+        if self.m_context is None:
+            self.m_context = QOpenGLContext()
+            self.m_context.setFormat(self.requestedFormat())
+            if not self.m_context.create():
+                raise Exception('Failed to create an OpenGL context')
+            needsInitialise = True
+
+        if not self.m_context.makeCurrent(self.surface):
+            raise Exception('Failed to make the OpenGL context current')
+        makeStateCurrent().resetCounters()
+
+        if needsInitialise:
+            self.initialise()
+
+    def renderImage(self, max_frames=1000):
+        """Render the layers and return the image as a height x width x 4 uint8 array, top row first. Frames are
+        rendered until nothing asks for another one (eg while data is uploaded), at most max_frames."""
+        self.makeCurrent()
+        self.framebuffer.resize(self.width(), self.height())
+        self.framebuffer.bind()
+        self.renderFrames(max_frames)
+        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
+        self.image_reader.read(0, 0, self.width(), self.height(), gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, np.uint8, 4)
+        return self.image_reader.poll(wait=True)[::-1]
+
+    def delete(self):
+        if not self.m_context is None:
+            self.makeCurrent()
+            self.framebuffer.delete()
+            self.pick_framebuffer.delete()
+            self.image_reader.delete()
+            self.pixel_reader.delete()
+            # the programs, pooled buffers and binding cache of the context go with it
+            PROGRAM_CACHE.clear()
+            BUFFER_POOL.clear()
+            forgetState()
+            self.m_context.doneCurrent()
@@ -13,5 +13,8 @@ setup(
     entry_points = '''
         [console_scripts]
         flowchart=pyvi.scripts.flowchart:cli
+        octree=pyvi.scripts.octree:cli
+        render=pyvi.scripts.render:cli
+        bench=pyvi.scripts.bench:cli
     '''
 )
\ No newline at end of file
@@ -0,0 +1,33 @@
+import numpy as np
+
+from pyvi.gloo import attribFormat, PACKED_NORMAL
+from pyvi.octree import buildOctree
+
+
+def float64Attributes(n, seed=0):
+    # as read from the coords, normals, colors and intensity npy files of a dataset
+    rng = np.random.RandomState(seed)
+    normals = rng.standard_normal((n, 3))
+    normals /= np.linalg.norm(normals, axis=1)[:,None]
+    return {
+        'a_position': rng.uniform(-10, 10, (n, 3)),
+        'a_normal': normals,
+        'a_color': rng.uniform(0, 1, (n, 4)),
+        'a_intensity': rng.uniform(0, 1, n)
+    }
+
+def test_float64_input_is_stored_in_a_drawable_format(tmp_path):
+    attributes = float64Attributes(5000)
+    for vertex_format in ['float', 'compact']:
+        octree = buildOctree(attributes, str(tmp_path / vertex_format), node_size=1000, vertex_format=vertex_format)
+        dtype = octree.points.dtype
+        assert set(dtype.names) == set(attributes)
+        for name in dtype.names:
+            attribFormat(dtype[name])
+        if vertex_format == 'compact':
+            assert attribFormat(dtype['a_normal']) == attribFormat(PACKED_NORMAL)
+        # the first node holds a subset of the input points
+        positions = octree.nodePoints(0)['a_position']
+        assert positions.dtype.base == np.float32
+        rows = np.all(np.isin(attributes['a_position'].astype(np.float32), positions), axis=1)
+        assert rows.sum() == len(positions)
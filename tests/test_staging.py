@@ -0,0 +1,44 @@
+import numpy as np
+
+from pyvi.gloo import AttributeStager
+
+
+def clipMask(a_position, mi, ma):
+    # as pvPointPainterNode clips to its bbox_clip input
+    return np.all(np.logical_and(mi <= a_position, a_position <= ma), axis=1)
+
+def test_position_change_under_clip_box_restages_all_attributes():
+    rng = np.random.RandomState(1)
+    n = 1000
+    a_position = rng.uniform(-1, 1, (n, 3)).astype(np.float32)
+    # an intensity that identifies the input row of each point
+    a_intensity = np.arange(n, dtype=np.float32)
+    attributes = {'a_position': a_position, 'a_intensity': a_intensity}
+    mi, ma = np.full(3, -.5), np.full(3, .5)
+
+    stager = AttributeStager()
+    stager.stagePoints(attributes, 'float', clipMask(a_position, mi, ma))
+    old_rows = stager.rows
+
+    # only a_position changes, so other points fall inside the clip box
+    a_position = a_position + np.float32(.25)
+    attributes['a_position'] = a_position
+    struct_arrays = stager.stagePoints(attributes, 'float', clipMask(a_position, mi, ma), ['a_position'])
+
+    assert not np.array_equal(stager.rows, old_rows)
+    assert stager.rows.dtype == np.uint32
+    assert set(struct_arrays) == {'a_position', 'a_intensity'}
+    assert len(struct_arrays['a_position']) == len(struct_arrays['a_intensity']) == len(stager.rows)
+    np.testing.assert_array_equal(struct_arrays['a_position']['a_position'], a_position[stager.rows])
+    np.testing.assert_array_equal(struct_arrays['a_intensity']['a_intensity'], a_intensity[stager.rows])
+    assert np.all(clipMask(struct_arrays['a_position']['a_position'], mi, ma))
+
+def test_unchanged_rows_only_restage_changed_attributes():
+    n = 100
+    attributes = {'a_position': np.zeros((n, 3), dtype=np.float32), 'a_intensity': np.zeros(n, dtype=np.float32)}
+    stager = AttributeStager()
+    stager.stagePoints(attributes)
+    attributes['a_intensity'] = np.ones(n, dtype=np.float32)
+    struct_arrays = stager.stagePoints(attributes, changed=['a_intensity'])
+    assert list(struct_arrays) == ['a_intensity']
+    np.testing.assert_array_equal(struct_arrays['a_intensity']['a_intensity'], 1)